@@ -0,0 +1,70 @@
+# Albums whose details could not be fetched because of a transient upstream error.
+# Their fallback track count is cached with a short TTL that doubles with every failed attempt,
+# and a background job retries them off the request path.
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from file_cache import SUBDIR
+from sqlite_util import LocalConnection
+
+FALLBACK_BASE_TTL = 1 / 24  # days
+FALLBACK_MAX_TTL = 7  # days
+RETRY_BATCH_SIZE = 20
+RETRY_INTERVAL = 600  # seconds
+
+connection = LocalConnection(SUBDIR / "fallbacks.sqlite", schema=(
+    "CREATE TABLE IF NOT EXISTS fallbacks ("
+    " artist TEXT NOT NULL,"
+    " album TEXT NOT NULL,"
+    " attempts INTEGER NOT NULL,"
+    " first_failed REAL NOT NULL,"
+    " last_failed REAL NOT NULL,"
+    " PRIMARY KEY (artist, album)"
+    ")",
+))
+
+
+def ttl_days(attempts: int) -> float:
+    return min(FALLBACK_MAX_TTL, FALLBACK_BASE_TTL * 2 ** (attempts - 1))
+
+
+def record_failure(artist: str, album: str):
+    now = time.time()
+    connection().execute(
+        "INSERT INTO fallbacks (artist, album, attempts, first_failed, last_failed) VALUES (?, ?, 1, ?, ?)"
+        " ON CONFLICT (artist, album) DO UPDATE SET attempts = attempts + 1, last_failed = excluded.last_failed",
+        (artist, album, now, now),
+    )
+
+
+def record_success(artist: str, album: str):
+    connection().execute("DELETE FROM fallbacks WHERE artist = ? AND album = ?", (artist, album))
+
+
+def get_keep_days(artist: str, album: str) -> Optional[float]:
+    # None when the album is not waiting for a retry.
+    row = connection().execute(
+        "SELECT attempts FROM fallbacks WHERE artist = ? AND album = ?", (artist, album)
+    ).fetchone()
+    return ttl_days(row[0]) if row else None
+
+
+def get_due(limit: int = RETRY_BATCH_SIZE) -> List[Tuple[str, str]]:
+    now = time.time()
+    due = []
+    for artist, album, attempts, last_failed in connection().execute(
+        "SELECT artist, album, attempts, last_failed FROM fallbacks ORDER BY last_failed"
+    ):
+        if last_failed + ttl_days(attempts) * 24 * 3600 < now:
+            due.append((artist, album))
+            if len(due) >= limit:
+                break
+    return due
+
+
+def get_summary():
+    attempts = Counter(dict(connection().execute(
+        "SELECT attempts, count(*) FROM fallbacks GROUP BY attempts"
+    ).fetchall()))
+    return dict(total=sum(attempts.values()), per_attempts=dict(sorted(attempts.items())))
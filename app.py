@@ -3,32 +3,37 @@
 # 2020-12-06
 
 
-import json
-from flask import Flask, request, send_file, make_response, redirect
+from flask import Flask, Response, request, send_file, make_response, redirect, jsonify, stream_with_context
 from jinja2 import Environment, PackageLoader, select_autoescape
 from flask_apscheduler import APScheduler
 
 
+import mimetypes
 import sys
-from os import path, getenv
+from os import path, getenv, getpid
 
 from datetime import datetime
-from functools import lru_cache
+from pathlib import Path
 from calendar import month_name
 
 from scrape import (
     username_exists,
-    cache_binary_url_and_return_path,
+    get_album_details_stats,
+    get_album_stats_version,
+    retry_album_details_fallbacks,
 )
 from util import (
     render_title_template,
     render_msg_template,
     logger,
-    get_recent_users_with_stats,
+    refresh_homepage_snapshot,
     add_recent_user,
     get_user_stats,
+    get_user_raw_stats,
+    stream_corrected_stats,
     get_user_overview,
     render_overview_block,
+    render_overview_blocks,
     save_correction,
     get_period_stats,
 )
@@ -38,6 +43,16 @@ from subscribe_util import (
     save_confirmed_subscription,
 )
 from rss_util import generate_feed
+from covers import get_cover_path, get_cover_stats, pick_format, record_page_view
+from http_cache import DAY_MAX_AGE, IMMUTABLE_MAX_AGE, conditional_response, day_etag, make_etag, max_age_for
+from cache_janitor import run_janitor_job, JANITOR_INTERVAL
+from file_cache import SUBDIR, get_cache_stats, served_stale, key_lock
+from fanout import served_partial
+from album_fallbacks import RETRY_INTERVAL
+import recent_users
+from ratelimit import limiter
+from circuitbreaker import get_circuit_stats
+from http_client import get_http_stats
 
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
@@ -49,20 +64,70 @@ env = Environment(
 )
 
 
+# Set COVER_X_ACCEL=1 when nginx serves the cache dir on the internal location X_ACCEL_PREFIX.
+COVER_X_ACCEL = bool(int(getenv("COVER_X_ACCEL") or 0))
+X_ACCEL_PREFIX = "/_cache/"
+
+
 scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
+if int(getenv("CACHE_JANITOR") or 0):
+    scheduler.add_job(
+        id="cache_janitor",
+        func=run_janitor_job,
+        trigger="interval",
+        seconds=JANITOR_INTERVAL,
+    )
+
+
+def retry_album_details_fallbacks_job():
+    # Scheduled in every worker, only one of them does the work.
+    with key_lock("retry_album_details_fallbacks", "run", timeout=0) as acquired:
+        if acquired:
+            retry_album_details_fallbacks()
+
+
+scheduler.add_job(
+    id="retry_album_details_fallbacks",
+    func=retry_album_details_fallbacks_job,
+    trigger="interval",
+    seconds=RETRY_INTERVAL,
+)
+
+
+def homepage_snapshot_job():
+    # Scheduled in every worker, also right after it starts. Workers restart often (--max-requests), so only
+    # refresh when no worker did for about SNAPSHOT_INTERVAL.
+    with key_lock("homepage_snapshot", "run", timeout=0) as acquired:
+        if acquired and recent_users.get_snapshot_age() > recent_users.SNAPSHOT_INTERVAL * 0.9:
+            refresh_homepage_snapshot()
+
+
+scheduler.add_job(
+    id="homepage_snapshot",
+    func=homepage_snapshot_job,
+    trigger="interval",
+    seconds=recent_users.SNAPSHOT_INTERVAL,
+    next_run_time=datetime.now(),
+)
 
 
 # ############# routes #######################
 
 
+@app.before_request
+def reset_served_stale():
+    served_stale.set([])
+    served_partial.set([])
+
+
 @app.route("/")
 @logger()
-@lru_cache()
 def index():
+    # The recent users are computed by homepage_snapshot_job, so this never waits for last.fm.
     return env.get_template("index.html").render(
-        title="Welcome!", recent_users=json.loads(get_recent_users_with_stats())
+        title="Welcome!", recent_users=recent_users.get_snapshot()
     )
 
 
@@ -80,8 +145,30 @@ def robots():
 def static_cover(file_name):
     if file_name == "unknown.png":
         return app.send_static_file(file_name)
+    # ?size= selects a resized variant, in WebP when the browser accepts it.
+    size = request.args.get("size", type=int)
+    fmt = pick_format(request.headers.get("Accept"))
     # Undo the replace and get the file path from the cache. We use the real file path here so send_file() can use it to set the appropriate last-modified headers.
-    return send_file(cache_binary_url_and_return_path(file_name.replace("-", "/")))
+    # The image behind a cover url never changes, so a client that has it can keep it.
+    response = conditional_response(
+        lambda: send_cover(*get_cover_path(file_name.replace("-", "/"), size, fmt)),
+        etag=make_etag("cover", file_name, size, fmt),
+        max_age=IMMUTABLE_MAX_AGE,
+        immutable=True,
+    )
+    response.vary.add("Accept")
+    return response
+
+
+def send_cover(cover_path, mimetype=None):
+    mimetype = mimetype or mimetypes.guess_type(cover_path)[0] or "application/octet-stream"
+    if not COVER_X_ACCEL:
+        return send_file(cover_path, mimetype=mimetype)
+    # Let nginx send the file from the cache dir, see setup/nginx/albumscrobbles.conf.
+    response = make_response("")
+    response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + str(Path(cover_path).relative_to(SUBDIR))
+    response.headers["Content-Type"] = mimetype
+    return response
 
 
 @app.route("/get_stats/detail")
@@ -93,7 +180,11 @@ def render_album_stats_year_month():
     month = None if month in ['', 'None'] else int(month)
     week = request.args.get("week")
     week = None if week in ['', 'None'] else int(week)
-    return render_overview_block(username, year, month, week)
+    return conditional_response(
+        lambda: render_overview_block(username, year, month, week),
+        etag=day_etag("detail", username, year, month, week),
+        max_age=DAY_MAX_AGE,
+    )
 
 
 @app.route("/get_stat")
@@ -111,6 +202,15 @@ def period_stats():
         period_str = f'{ monthname(month) } of { year }'
     else:
         period_str = year
+    return conditional_response(
+        lambda: render_period_stats(username, year, month, week, period_str),
+        etag=day_etag("period", username, year, month, week),
+        max_age=DAY_MAX_AGE,
+    )
+
+
+def render_period_stats(username, year, month, week, period_str):
+    record_page_view()
     corrected_sorted = get_period_stats(username, year, month, week)
     top_album_cover_filename = "unknown.png"
     if corrected_sorted and corrected_sorted[0] and corrected_sorted[0]["cover_url"]:
@@ -123,14 +223,23 @@ def period_stats():
         stats=corrected_sorted,
         top_album_cover_path="/static/cover/" + top_album_cover_filename,
         disable_menu=True,
+        data_may_be_stale=bool(served_stale.get()),
     )
 
 
+def stream_template(name, **context):
+    # Send the page while it is rendered. nginx buffers proxied responses unless they say otherwise.
+    response = Response(stream_with_context(env.get_template(name).generate(**context)))
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @logger()
 def render_user_stats(username: str, drange: str, year: str = None, overview_per_week: bool = False):
     username = username.strip()
     assert username and username_exists(username), 'invalid user'
     add_recent_user(username)
+    record_page_view()
     if drange == "overview":
         overview = get_user_overview(username, year and int(year), overview_per_week)
         # Trick to get the start_year and current_year. The function is cached so it's quick.
@@ -149,7 +258,7 @@ def render_user_stats(username: str, drange: str, year: str = None, overview_per
                     title=msg,
                     text=msg,
                 ), 404
-        return env.get_template("overview.html").render(
+        context = dict(
             title=f"Album stats for {username} ({t})",
             year=year and int(year),
             start_year=start_year,
@@ -159,6 +268,30 @@ def render_user_stats(username: str, drange: str, year: str = None, overview_per
             per=overview_per_week and "week" or "month",
             selected_range=drange,
         )
+        if request.args.get("stream") == "0":
+            # One htmx request per tile
+            return env.get_template("overview.html").render(**context)
+        # Send the page right away and stream the tiles as they are rendered, all in this request.
+        tiles = render_overview_blocks(username, year and int(year), overview)
+        return stream_template("overview.html", **context, tiles=tiles)
+    title = f'Album stats for {username} ({drange+" days" if drange else "all time"})'
+    if request.args.get("stream") != "0":
+        # Send the original top album right away and the corrected stats while the albums are resolved.
+        stats, original_album, original_artist, blast_name, blast_period = get_user_raw_stats(username, drange)
+        return stream_template(
+            "stats_stream.html",
+            title=title,
+            username=username,
+            original_top_album=dict(
+                name=original_album,
+                artist=original_artist,
+            ),
+            updates=stream_corrected_stats(stats),
+            selected_range=drange,
+            blast_name=blast_name,
+            blast_period=blast_period,
+            data_may_be_stale=bool(served_stale.get()),
+        )
     (
         corrected_sorted,
         original_album,
@@ -168,7 +301,7 @@ def render_user_stats(username: str, drange: str, year: str = None, overview_per
         blast_period,
     ) = get_user_stats(username, drange)
     return env.get_template("stats.html").render(
-        title=f'Album stats for {username} ({drange+" days" if drange else "all time"})',
+        title=title,
         username=username,
         original_top_album=dict(
             name=original_album,
@@ -179,6 +312,7 @@ def render_user_stats(username: str, drange: str, year: str = None, overview_per
         selected_range=drange,
         blast_name=blast_name,
         blast_period=blast_period,
+        data_may_be_stale=bool(served_stale.get()),
     )
 
 
@@ -195,8 +329,23 @@ def get_stats():
     # TODO move overview check to here
     year = drange == "overview" and request.args.get("year")
     overview_per_week = bool(drange == "overview" and request.args.get("per") == "week")
+    username = username.replace('/', '').strip()
+    if drange == "overview":
+        etag = day_etag("overview", username, year, overview_per_week, request.args.get("stream"))
+        max_age, last_modified = DAY_MAX_AGE, None
+    elif drange != "random":
+        last_modified, keep_days = get_album_stats_version(username, drange)
+        etag = last_modified and make_etag("stats", username, drange, last_modified, request.args.get("stream"))
+        max_age = last_modified and max_age_for(last_modified, keep_days)
+    else:
+        etag = max_age = last_modified = None  # A different period every time
     try:
-        return render_user_stats(username.replace('/', ''), drange, year, overview_per_week)
+        return conditional_response(
+            lambda: render_user_stats(username, drange, year, overview_per_week),
+            etag=etag,
+            max_age=max_age,
+            last_modified=last_modified,
+        )
     except AssertionError as e:
         print(e)
         return render_title_template(
@@ -284,11 +433,29 @@ def feed(username):
     username = username.strip()
     if not username_exists(username):
         return 'Unknown user', 404
+    return conditional_response(lambda: render_feed(username), etag=day_etag("feed", username), max_age=DAY_MAX_AGE)
+
+
+def render_feed(username):
     rss_xml = generate_feed(username)
     response = make_response(rss_xml)
     response.headers['Content-Type'] = 'text/xml'
     return response
 
+
+@app.route("/cache_stats")
+def cache_stats():
+    # Counters are per worker process.
+    return jsonify(
+        pid=getpid(),
+        cache=get_cache_stats(),
+        album_details=get_album_details_stats(),
+        rate_limits=limiter.get_stats(),
+        circuits=get_circuit_stats(),
+        http=get_http_stats(),
+        covers=get_cover_stats(),
+    )
+
 # ############# /routes #######################
 
 
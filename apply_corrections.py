@@ -13,6 +13,7 @@ import file_cache
 with open(Path(dirname(__file__)) / "corrections.txt") as f:
     corrections_lines = f.readlines()
 corrections = Counter(corrections_lines)
+updated = False
 
 for correction, count in corrections.items():
     if count < 2:
@@ -32,3 +33,8 @@ for correction, count in corrections.items():
         func_name="_get_album_details",
         result=",".join((count, img_url))
     )
+    updated = True
+
+if updated:
+    # Make the new track counts visible to the in-memory caches of the running workers.
+    file_cache.invalidate("_get_album_details")
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Compare lookup latency and inode usage of the cache backends.
+# Usage: python benchmarks/bench_file_cache.py [--entries 100000] [--lookups 10000]
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from random import choice
+
+import click
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache_backends import FileBackend, SqliteBackend  # noqa: E402
+
+FUNC_NAME = "_get_album_details"
+
+
+def count_inodes(path: Path) -> int:
+    return sum(1 + len(files) for _root, _dirs, files in os.walk(path))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def fill(backend, keys):
+    if isinstance(backend, SqliteBackend):
+        conn = backend.connection()
+        conn.execute("BEGIN")
+    for i, key in enumerate(keys):
+        backend.set(FUNC_NAME, key, f"{i % 20 + 3},https://lastfm.freetls.fastly.net/i/u/300x300/{i:032x}.png")
+    if isinstance(backend, SqliteBackend):
+        conn.execute("COMMIT")
+
+
+def bench(backend, keys, lookups):
+    timings = []
+    for _ in range(lookups):
+        key = choice(keys)
+        start = time.perf_counter()
+        backend.get(FUNC_NAME, key)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@click.command()
+@click.option("--entries", default=100_000)
+@click.option("--lookups", default=10_000)
+def main(entries, lookups):
+    keys = [f"Artist {i}-Album {i}" for i in range(entries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in (FileBackend(Path(tmp) / "files"), SqliteBackend(Path(tmp) / "sqlite" / "cache.sqlite")):
+            start = time.perf_counter()
+            fill(backend, keys)
+            fill_time = time.perf_counter() - start
+            timings = bench(backend, keys, lookups)
+            root = backend.root if isinstance(backend, FileBackend) else backend.filename.parent
+            print(
+                f"{backend.name:>6}: {entries} entries written in {fill_time:.1f}s, "
+                f"lookup p50 {percentile(timings, 50) * 1e6:.0f}us p99 {percentile(timings, 99) * 1e6:.0f}us, "
+                f"inodes {count_inodes(root)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Wall-clock time of the overview pages of a 15 year old account, sequential versus on the overview pool.
+# last.fm is simulated with a fixed latency per period, so the result only depends on the concurrency.
+# Usage: python benchmarks/bench_overview.py [--years 15] [--latency 0.3] [--concurrency 6]
+import os
+import sys
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+import click
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fanout  # noqa: E402
+import scrape  # noqa: E402
+
+
+def run(years, latency, concurrency):
+    def get_stats(username, year, period=None):
+        time.sleep(latency)
+        return [["Album", "Artist", "1", "1"]]
+
+    fanout.POOL_SIZES["overview"] = concurrency
+    fanout._executors.clear()
+    timings = dict()
+    start_year = datetime.today().year - years
+    with patch("scrape.get_username_start_year", return_value=start_year), \
+            patch("scrape.get_album_stats_year_month", get_stats), patch("scrape.get_album_stats_year_week", get_stats):
+        for name, overview in (
+            ("per year", lambda: scrape.get_overview_per_year("user")),
+            ("per month", lambda: scrape.get_overview_per_month("user", start_year)),
+            ("per week", lambda: scrape.get_overview_per_week("user", start_year)),
+        ):
+            start = time.perf_counter()
+            overview()
+            timings[name] = time.perf_counter() - start
+    return timings
+
+
+@click.command()
+@click.option("--years", default=15)
+@click.option("--latency", default=0.3, help="Seconds per period")
+@click.option("--concurrency", default=fanout.POOL_SIZES["overview"])
+def main(years, latency, concurrency):
+    before = run(years, latency, 1)
+    after = run(years, latency, concurrency)
+    for name in before:
+        print(f"{name:>9}: sequential {before[name]:.1f}s, concurrency {concurrency} {after[name]:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
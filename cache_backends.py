@@ -0,0 +1,342 @@
+# Storage engines for file_cache
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlite_util import LocalConnection
+
+# value is str or bytes, updated is a unix timestamp
+Entry = namedtuple("Entry", "value updated")
+# Metadata used by the janitor. Timestamps are unix timestamps.
+# handle identifies the stored entry for delete_many().
+EntryInfo = namedtuple("EntryInfo", "key size updated accessed handle")
+
+# Access times are only written when the recorded one is older than this (seconds), so a cache hit is normally read-only.
+ACCESS_RESOLUTION = 3600
+
+
+class CacheMiss(FileNotFoundError):
+    # Subclass of FileNotFoundError so existing callers that catch that keep working for every backend.
+    pass
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+class FileBackend:
+    # One file per key: <root>/v2/<func_name>/ab/cd/<hash of key>[.ext]. The modification time is the update timestamp.
+    # The original keys are appended to <func_name>/keys.log for debugging.
+    # Entries in the old flat layout (<root>/<func_name>/<legacy key>) are moved over when they are read.
+    name = "file"
+    layout_dir = "v2"
+    key_log = "keys.log"
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, func_name, key) -> Path:
+        h = hash_key(key)
+        # Keep a file extension so send_file and nginx can still guess the mimetype of covers.
+        suffix = Path(key.rsplit("/", 1)[-1]).suffix
+        if not re.fullmatch(r"\.[A-Za-z0-9]{1,5}", suffix):
+            suffix = ""
+        return self.root / self.layout_dir / func_name / h[:2] / h[2:4] / (h + suffix)
+
+    def legacy_path(self, func_name, legacy_key) -> Path:
+        return self.root / Path(f"{func_name}/{legacy_key}")
+
+    def get(self, func_name, key, binary=False, legacy_key=None) -> Entry:
+        filename = self.path(func_name, key)
+        try:
+            with open(filename, "rb" if binary else "r") as f:
+                st = os.fstat(f.fileno())
+                value = f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            if legacy_key and self.adopt_legacy(func_name, key, legacy_key):
+                return self.get(func_name, key, binary)
+            raise CacheMiss(filename)
+        self.record_access(filename, st)
+        return Entry(value, st.st_mtime)
+
+    def record_access(self, filename, st):
+        now = time.time()
+        if now - st.st_atime > ACCESS_RESOLUTION:
+            # Keep the mtime, it is the update timestamp.
+            os.utime(filename, (now, st.st_mtime))
+
+    def stat(self, func_name, key):
+        # Update timestamp of an entry that is used by its path (eg. sent by nginx), without reading the value.
+        # Records the access like get(). None when not cached.
+        filename = self.path(func_name, key)
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        self.record_access(filename, st)
+        return st.st_mtime
+
+    def adopt_legacy(self, func_name, key, legacy_key) -> bool:
+        # Move an entry from the old flat layout into the hashed layout. The rename keeps the mtime.
+        legacy = self.legacy_path(func_name, legacy_key)
+        if not legacy.is_file():
+            return False
+        filename = self.path(func_name, key)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(legacy, filename)
+        except FileNotFoundError:
+            return False  # Another worker moved it already
+        self.log_key(func_name, key, filename)
+        return True
+
+    def log_key(self, func_name, key, filename):
+        # Lines are appended in a single write, which is atomic for small writes with O_APPEND.
+        with open(self.root / self.layout_dir / func_name / self.key_log, "a") as f:
+            f.write(json.dumps([filename.name, key]) + "\n")
+
+    def read_key_log(self, func_name) -> dict:
+        keys = dict()
+        try:
+            with open(self.root / self.layout_dir / func_name / self.key_log) as f:
+                for line in f:
+                    try:
+                        name, key = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written line
+                    keys[name] = key
+        except FileNotFoundError:
+            pass
+        return keys
+
+    def updated(self, func_name, key):
+        # Update timestamp without reading the value, or None when not cached.
+        try:
+            return os.stat(self.path(func_name, key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def set(self, func_name, key, value, keep_days=None, updated=None):
+        filename = self.path(func_name, key)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        is_new = not filename.exists()
+        with open(filename, "wb" if isinstance(value, bytes) else "w") as f:
+            f.write(value)
+        if updated:
+            os.utime(filename, (updated, updated))
+        if is_new:
+            self.log_key(func_name, key, filename)
+
+    def touch(self, func_name, key, keep_days=None):
+        # Renew the update timestamp, eg. after upstream confirmed the value did not change.
+        now = time.time()
+        os.utime(self.path(func_name, key), (now, now))
+
+    def delete(self, func_name, key):
+        try:
+            os.remove(self.path(func_name, key))
+        except FileNotFoundError:
+            pass
+
+    def delete_many(self, func_name, entries):
+        for e in entries:
+            try:
+                os.remove(e.handle)
+            except FileNotFoundError:
+                pass
+        # Drop the deleted entries from the key log. Keys appended meanwhile by other workers can get lost,
+        # which only affects debugging.
+        deleted = {Path(e.handle).name for e in entries}
+        if deleted:
+            keys = self.read_key_log(func_name)
+            log = self.root / self.layout_dir / func_name / self.key_log
+            tmp = log.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                for name, key in keys.items():
+                    if name not in deleted:
+                        f.write(json.dumps([name, key]) + "\n")
+            os.replace(tmp, log)
+
+    def namespaces(self):
+        return sorted(set(self._namespaces(self.root / self.layout_dir)) | set(self.legacy_namespaces()))
+
+    def legacy_namespaces(self):
+        return self._namespaces(self.root)
+
+    def _namespaces(self, root):
+        if not root.exists():
+            return []
+        return [
+            d.name for d in root.iterdir()
+            if d.is_dir() and not d.name.startswith(".") and d.name != self.layout_dir
+        ]
+
+    def scan(self, func_name):
+        # Includes entries in the old flat layout, so the janitor also cleans those up.
+        keys = self.read_key_log(func_name)
+        for filename, is_legacy in self._files(func_name):
+            st = filename.stat()
+            key = filename.name if is_legacy else keys.get(filename.name, filename.name)
+            yield EntryInfo(key, st.st_size, st.st_mtime, st.st_atime, str(filename))
+
+    def _files(self, func_name):
+        func_dir = self.root / self.layout_dir / func_name
+        if func_dir.exists():
+            for dirpath, _dirnames, filenames in os.walk(func_dir):
+                for name in filenames:
+                    if dirpath != str(func_dir):  # Skip the key log
+                        yield Path(dirpath) / name, False
+        legacy_dir = self.root / func_name
+        if legacy_dir.exists():
+            with os.scandir(legacy_dir) as it:
+                for f in it:
+                    if f.is_file():
+                        yield Path(f.path), True
+
+    def items(self):
+        # Yields (func_name, key, Entry) for every entry. Used for migrations.
+        # Entries in the old flat layout get their legacy key, which the SQLite backend re-keys when they are read.
+        for func_name in self.namespaces():
+            keys = self.read_key_log(func_name)
+            for filename, is_legacy in self._files(func_name):
+                key = filename.name if is_legacy else keys.get(filename.name)
+                if key is None:
+                    continue  # Original key unknown
+                with open(filename, "rb") as f:
+                    value = f.read()
+                try:
+                    # Text entries are stored as text, binary entries (images) are never valid utf-8.
+                    value = value.decode("utf-8")
+                except UnicodeDecodeError:
+                    pass
+                yield func_name, key, Entry(value, filename.stat().st_mtime)
+
+
+def add_accessed_column(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+    if "accessed" not in columns:
+        # Databases created before access tracking was added
+        conn.execute("ALTER TABLE cache ADD COLUMN accessed REAL")
+
+
+class SqliteBackend:
+    # All entries in a single SQLite database in WAL mode, so lookups do not need a stat() and open() per key.
+    name = "sqlite"
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        # One connection per thread and per process (gunicorn forks workers).
+        self.connection = LocalConnection(filename, schema=(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " func_name TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " updated REAL NOT NULL,"
+            " expires REAL,"  # NULL means keep forever
+            " accessed REAL,"
+            " PRIMARY KEY (func_name, key)"
+            ") WITHOUT ROWID",
+        ), migrate=add_accessed_column)
+
+    def get(self, func_name, key, binary=False, legacy_key=None) -> Entry:
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT value, updated, accessed FROM cache WHERE func_name = ? AND key = ?",
+            (func_name, key),
+        ).fetchone()
+        if row is None and legacy_key and legacy_key != key:
+            # Entry migrated from the old flat file layout. Re-key it.
+            cursor = conn.execute(
+                "UPDATE OR IGNORE cache SET key = ? WHERE func_name = ? AND key = ?", (key, func_name, legacy_key)
+            )
+            if cursor.rowcount:
+                return self.get(func_name, key, binary)
+        if row is None:
+            raise CacheMiss(f"{func_name}/{key}")
+        value, updated, accessed = row
+        now = time.time()
+        if now - (accessed or updated) > ACCESS_RESOLUTION:
+            conn.execute(
+                "UPDATE cache SET accessed = ? WHERE func_name = ? AND key = ?", (now, func_name, key)
+            )
+        # Values migrated from the file backend may have been stored with the other type.
+        if binary and isinstance(value, str):
+            value = value.encode("utf-8")
+        elif not binary and isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return Entry(value, updated)
+
+    def updated(self, func_name, key):
+        row = self.connection().execute(
+            "SELECT updated FROM cache WHERE func_name = ? AND key = ?", (func_name, key)
+        ).fetchone()
+        return row and row[0]
+
+    def set(self, func_name, key, value, keep_days=None, updated=None):
+        updated = updated or datetime.now().timestamp()
+        expires = (
+            (datetime.fromtimestamp(updated) + timedelta(days=keep_days)).timestamp()
+            if keep_days
+            else None
+        )
+        self.connection().execute(
+            "INSERT OR REPLACE INTO cache (func_name, key, value, updated, expires) VALUES (?, ?, ?, ?, ?)",
+            (func_name, key, value, updated, expires),
+        )
+
+    def touch(self, func_name, key, keep_days=None):
+        now = datetime.now()
+        self.connection().execute(
+            "UPDATE cache SET updated = ?, expires = ? WHERE func_name = ? AND key = ?",
+            (now.timestamp(), keep_days and (now + timedelta(days=keep_days)).timestamp(), func_name, key),
+        )
+
+    def delete(self, func_name, key):
+        self.connection().execute(
+            "DELETE FROM cache WHERE func_name = ? AND key = ?", (func_name, key)
+        )
+
+    def namespaces(self):
+        return [row[0] for row in self.connection().execute("SELECT DISTINCT func_name FROM cache ORDER BY func_name")]
+
+    def scan(self, func_name):
+        for key, size, updated, accessed in self.connection().execute(
+            "SELECT key, length(value), updated, accessed FROM cache WHERE func_name = ?", (func_name,)
+        ):
+            yield EntryInfo(key, size, updated, accessed or updated, key)
+
+    def delete_many(self, func_name, entries):
+        conn = self.connection()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "DELETE FROM cache WHERE func_name = ? AND key = ?", ((func_name, e.handle) for e in entries)
+        )
+        conn.execute("COMMIT")
+
+    def items(self):
+        for func_name, key, value, updated in self.connection().execute(
+            "SELECT func_name, key, value, updated FROM cache"
+        ):
+            yield func_name, key, Entry(value, updated)
+
+
+def migrate(source, target, batch_size=1000) -> int:
+    # One-shot copy of every entry from source to target, keeping the update timestamps.
+    count = 0
+    conn = target.connection() if isinstance(target, SqliteBackend) else None
+    if conn:
+        conn.execute("BEGIN")
+    for func_name, key, entry in source.items():
+        target.set(func_name, key, entry.value, updated=entry.updated)
+        count += 1
+        if conn and count % batch_size == 0:
+            conn.execute("COMMIT")
+            conn.execute("BEGIN")
+    if conn:
+        conn.execute("COMMIT")
+    return count
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Maintenance commands for the file cache.
+import time
+from pathlib import Path
+
+import click
+
+import file_cache
+from cache_backends import FileBackend, SqliteBackend, migrate
+from cache_janitor import run_janitor, print_reports
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("migrate-sqlite")
+@click.option("--source", default=None, help="Cache directory to read. Defaults to the file_cache SUBDIR.")
+@click.option("--target", default=None, help="SQLite database to write. Defaults to SUBDIR/cache.sqlite.")
+def migrate_sqlite(source, target):
+    """One-shot copy of the file-per-key cache tree into the SQLite backend"""
+    source_backend = FileBackend(source or file_cache.SUBDIR)
+    target_backend = SqliteBackend(target or file_cache.SUBDIR / file_cache.SQLITE_FILENAME)
+    count = migrate(source_backend, target_backend)
+    print(f"Migrated {count} entries to {target_backend.filename}.")
+    print("Set CACHE_BACKEND=sqlite to use it.")
+
+
+@cli.command("janitor")
+@click.option("--dry-run", is_flag=True, help="Only report what would be reclaimed.")
+def janitor(dry_run):
+    """Purge expired entries and evict least recently used entries over budget"""
+    # Import the decorated functions so their keep_days are known.
+    import scrape  # noqa: F401
+    import util  # noqa: F401
+    print_reports(run_janitor(dry_run=dry_run))
+
+
+@cli.command("purge-legacy")
+@click.option("--unused-days", default=30, help="Remove entries in the old flat layout that were not read for this many days.")
+@click.option("--dry-run", is_flag=True)
+def purge_legacy(unused_days, dry_run):
+    """Finish the migration to the hashed key layout
+
+    Entries in the old flat layout are moved to the hashed layout when they are read. Their original
+    arguments can not be recovered from the truncated filenames, so entries that were not read for a while are removed.
+    """
+    backend = FileBackend(file_cache.SUBDIR)
+    cutoff = time.time() - unused_days * 24 * 3600
+    for func_name in backend.legacy_namespaces():
+        legacy_dir = backend.root / func_name
+        unused = [f for f in legacy_dir.iterdir() if f.is_file() and f.stat().st_atime < cutoff]
+        remaining = sum(1 for f in legacy_dir.iterdir()) - len(unused)
+        print(f"{func_name}: {len(unused)} unused legacy entries, {remaining} remaining.")
+        if dry_run:
+            continue
+        for f in unused:
+            f.unlink()
+        if not remaining:
+            legacy_dir.rmdir()
+
+
+@cli.command("migrate-base64")
+@click.option("--dry-run", is_flag=True)
+def migrate_base64(dry_run):
+    """Move the images cached as base64 text by get_image_base64 into the binary cache of the covers"""
+    import base64
+    func_name, binary_func_name = "get_image_base64", "cache_binary_url_and_return_path"
+    backend = file_cache.backend
+    # Same backend as binary_file_cache_decorator(return_path=True) uses
+    binary_backend = backend if hasattr(backend, "path") else FileBackend(file_cache.SUBDIR)
+    entries = list(backend.scan(func_name))
+    moved = 0
+    for e in entries:
+        # Keys of the old flat layout have the slashes of the url replaced, like the cover urls.
+        url = e.key if "://" in e.key else e.key.replace("-", "/")
+        if not url.startswith("http") or binary_backend.updated(binary_func_name, file_cache.make_key(url)):
+            continue
+        if isinstance(backend, FileBackend):
+            value = Path(e.handle).read_text()  # Also for entries in the old flat layout
+        else:
+            value = backend.get(func_name, e.key).value
+        if not dry_run:
+            binary_backend.set(binary_func_name, file_cache.make_key(url), base64.b64decode(value))
+        moved += 1
+    print(f"{func_name}: {moved} of {len(entries)} images moved to {binary_func_name}.")
+    if not dry_run:
+        backend.delete_many(func_name, entries)
+
+
+@cli.command("key")
+@click.argument("func_name")
+@click.argument("filename")
+def key(func_name, filename):
+    """Print the original key of a file in the hashed layout"""
+    print(FileBackend(file_cache.SUBDIR).read_key_log(func_name).get(Path(filename).name, "Unknown"))
+
+
+@cli.command("fallback-report")
+def fallback_report():
+    """Report cached album details that are on the fallback track count"""
+    import album_fallbacks
+    from scrape import AVERAGE_ALBUM_TRACK_COUNT
+    summary = album_fallbacks.get_summary()
+    print(f"Waiting for a retry after a transient error: {summary['total']}")
+    for attempts, count in summary["per_attempts"].items():
+        print(f"  {attempts} failed attempts: {count}")
+    backend = file_cache.backend
+    fallback = f"{AVERAGE_ALBUM_TRACK_COUNT},"
+    total = on_fallback = 0
+    for func_name, _key, entry in backend.items():
+        if func_name != "_get_album_details":
+            continue
+        total += 1
+        on_fallback += entry.value.startswith(fallback)
+    print(f"Cached albums on the average track count: {on_fallback} of {total}")
+
+
+if __name__ == "__main__":
+    cli()
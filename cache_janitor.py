@@ -0,0 +1,84 @@
+# Keeps the cache within a byte and entry budget per function.
+# Entries past keep_days are purged, then least recently used entries are evicted until the namespace fits its budget.
+import time
+from collections import namedtuple
+
+import file_cache
+from cache_backends import FileBackend
+
+MB = 1024 * 1024
+Budget = namedtuple("Budget", "max_bytes max_entries")
+DEFAULT_BUDGET = Budget(max_bytes=200 * MB, max_entries=200_000)
+BUDGETS = {
+    "_get_album_details": Budget(max_bytes=200 * MB, max_entries=1_000_000),
+    "cache_binary_url_and_return_path": Budget(max_bytes=2048 * MB, max_entries=100_000),
+    "get_album_stats_cached": Budget(max_bytes=500 * MB, max_entries=500_000),
+    # Rendered fragments, see file_cache.fragment_cache_decorator
+    "fragment_render_overview_block": Budget(max_bytes=100 * MB, max_entries=100_000),
+    "fragment_get_stat_for_rss": Budget(max_bytes=50 * MB, max_entries=50_000),
+}
+JANITOR_INTERVAL = 3600  # seconds
+
+Report = namedtuple("Report", "func_name expired evicted reclaimed_bytes remaining_entries remaining_bytes")
+
+
+def clean_namespace(backend, func_name, budget, keep_days=None, dry_run=False) -> Report:
+    now = time.time()
+    entries = list(backend.scan(func_name))
+    expired = [e for e in entries if keep_days and e.updated + keep_days * 24 * 3600 < now]
+    expired_keys = {e.key for e in expired}
+    # Least recently used first
+    remaining = sorted((e for e in entries if e.key not in expired_keys), key=lambda e: e.accessed)
+    remaining_bytes = sum(e.size for e in remaining)
+    evicted = []
+    while remaining and (remaining_bytes > budget.max_bytes or len(remaining) > budget.max_entries):
+        e = remaining.pop(0)
+        remaining_bytes -= e.size
+        evicted.append(e)
+    if not dry_run and (expired or evicted):
+        backend.delete_many(func_name, expired + evicted)
+    return Report(
+        func_name,
+        expired=len(expired),
+        evicted=len(evicted),
+        reclaimed_bytes=sum(e.size for e in expired + evicted),
+        remaining_entries=len(remaining),
+        remaining_bytes=remaining_bytes,
+    )
+
+
+def run_janitor(backends=None, budgets=None, dry_run=False):
+    # Covers are always stored in the directory layout, so clean that as well when another backend is in use.
+    if backends is None:
+        backends = [file_cache.backend]
+        if not isinstance(file_cache.backend, FileBackend):
+            backends.append(FileBackend(file_cache.SUBDIR))
+    budgets = budgets if budgets is not None else BUDGETS
+    reports = []
+    for backend in backends:
+        for func_name in backend.namespaces():
+            reports.append(
+                clean_namespace(
+                    backend,
+                    func_name,
+                    budgets.get(func_name, DEFAULT_BUDGET),
+                    keep_days=file_cache.NAMESPACES.get(func_name),
+                    dry_run=dry_run,
+                )
+            )
+    return reports
+
+
+def print_reports(reports):
+    for r in reports:
+        print(
+            f"{r.func_name}: purged {r.expired} expired, evicted {r.evicted}, reclaimed {r.reclaimed_bytes / MB:.1f}MB. "
+            f"Remaining: {r.remaining_entries} entries, {r.remaining_bytes / MB:.1f}MB"
+        )
+
+
+def run_janitor_job():
+    # Scheduled in every gunicorn worker. Only one of them does the work, the others skip this round.
+    with file_cache.key_lock("janitor", "run", timeout=0) as acquired:
+        if acquired:
+            print_reports(run_janitor())
@@ -0,0 +1,103 @@
+# Album stats for months, years and other periods, summed locally from the weekly charts of last.fm.
+# Every weekly chart is downloaded once and cached forever, instead of requesting a separate chart per period.
+# A weekly chart is counted in the period that contains its midpoint.
+# Periods with more than MAX_WEEKS_ON_REQUEST uncached weeks are fetched in a single call instead, while the
+# weekly charts are filled in by period_index in the background.
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Tuple
+
+import requests
+
+import period_index
+import scrobble_store
+from file_cache import file_cache_decorator, get_updated
+from utils.api import _get_weekly_chart_list_api, _get_weekly_album_chart_api
+
+MAX_WEEKS_ON_REQUEST = 1  # Weekly charts that are fetched while the visitor waits. More take a single call.
+
+
+@file_cache_decorator(keep_days=1, stale_while_revalidate=7, single_flight=True)
+def get_weekly_chart_list(username: str) -> str:
+    return _get_weekly_chart_list_api(username)
+
+
+@file_cache_decorator(single_flight=True, memory_max_entries=5_000)
+def get_weekly_album_chart(username: str, start: str, end: str) -> str:
+    # Only called for weeks in the past, so they can be cached forever.
+    chart = _get_weekly_album_chart_api(username, int(start), int(end))
+    period_index.record_week(username, int(start), int(end), len(json.loads(chart)))
+    return chart
+
+
+def weeks_between(chart_list: List, start_ts: int, end_ts: int) -> List[Tuple[int, int]]:
+    return [
+        (week_start, week_end)
+        for week_start, week_end in chart_list
+        if start_ts <= (week_start + week_end) // 2 < end_ts
+    ]
+
+
+def get_weeks_between(username: str, start_ts: int, end_ts: int) -> List[Tuple[int, int]]:
+    return weeks_between(json.loads(get_weekly_chart_list(username)), start_ts, end_ts)
+
+
+def sum_charts(charts: List[List], limit: int) -> List[Tuple[str, str, str, str]]:
+    # Same format as the charts of the api: (album, artist, playcount, rank)
+    playcounts = defaultdict(int)
+    for chart in charts:
+        for album_name, artist_name, playcount, _rank in chart:
+            playcounts[(album_name, artist_name)] += int(playcount)
+    top = sorted(playcounts.items(), key=lambda x: -x[1])[:limit]
+    return [
+        (album_name, artist_name, str(playcount), str(rank))
+        for rank, ((album_name, artist_name), playcount) in enumerate(top, start=1)
+    ]
+
+
+@file_cache_decorator(memory_max_entries=1_000)
+def get_album_stats_between_cached(username: str, start: str, end: str) -> str:
+    from scrape import MAX_ITEMS
+    now = datetime.now().timestamp()
+    weeks = [(s, e) for s, e in get_weeks_between(username, int(start), int(end)) if e <= now]
+    charts = [json.loads(get_weekly_album_chart(username, str(s), str(e))) for s, e in weeks]
+    return json.dumps(sum_charts(charts, MAX_ITEMS))
+
+
+def get_album_stats_in_one_call(username: str, start_ts: str, end_ts: str) -> List:
+    # The album chart of the period from a single user.getweeklyalbumchart call, like before the weekly charts
+    # were summed. Cached forever with the other blast from the past periods.
+    from scrape import get_album_stats
+    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklyalbumchart&user={username}&format=json&from={start_ts}&to={end_ts}"
+    return get_album_stats(username, url)
+
+
+def get_album_stats_between(username: str, start: datetime, end: datetime) -> List:
+    if scrobble_store.is_ready(username):
+        from scrape import MAX_ITEMS
+        return scrobble_store.get_album_stats(username, start, end, limit=MAX_ITEMS)
+    start_ts, end_ts = start.strftime("%s"), end.strftime("%s")
+    now = datetime.now().timestamp()
+    chart_list = json.loads(get_weekly_chart_list(username))
+    weeks = weeks_between(chart_list, int(start_ts), int(end_ts))
+    missing = [
+        (s, e) for s, e in weeks
+        if e <= now and not get_updated(username, str(s), str(e), func_name="get_weekly_album_chart")
+    ]
+    if len(missing) > MAX_WEEKS_ON_REQUEST:
+        # Fetching a month or year week by week would take too long. Fill in the weekly charts in the background
+        # for the next time.
+        period_index.index_in_background(username)
+        return get_album_stats_in_one_call(username, start_ts, end_ts)
+    # Only cache the sum when the chart list is up to date and every week in the period has ended.
+    complete = any(week_end >= int(end_ts) for _week_start, week_end in chart_list) and all(
+        week_end <= now for _week_start, week_end in weeks
+    )
+    try:
+        if complete:
+            return json.loads(get_album_stats_between_cached(username, start_ts, end_ts))
+        return json.loads(get_album_stats_between_cached.__wrapped__(username, start_ts, end_ts))
+    except requests.exceptions.RequestException as e:
+        print(f"Could not get the missing weekly chart of {username}, getting the period in one call: {e!r}")
+        return get_album_stats_in_one_call(username, start_ts, end_ts)
@@ -0,0 +1,98 @@
+# Circuit breaker per upstream host. After FAILURE_THRESHOLD consecutive failures calls fail immediately for
+# RESET_TIMEOUT seconds, then a single trial call decides whether the circuit closes again.
+# State is per process.
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from ratelimit import RateLimitedAdapter, RateLimitTimeout
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 60  # seconds
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    # A ConnectionError, so callers handle it like an unreachable upstream.
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def before_call(self, host):
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_running):
+                raise CircuitOpenError(f"Circuit for {host} is open")
+            if state == "half-open":
+                self.trial_running = True
+
+    def release_trial(self):
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.state != "open":
+                    print(f"Opening circuit for {host} after {self.failures} failures.")
+                self.opened_at = time.monotonic()
+
+
+breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host) -> CircuitBreaker:
+    with _breakers_lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker()
+        return breakers[host]
+
+
+def get_circuit_stats():
+    return {host: dict(state=b.state, failures=b.failures) for host, b in breakers.items()}
+
+
+class CircuitBreakerAdapter(RateLimitedAdapter):
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        breaker = get_breaker(host)
+        breaker.before_call(host)
+        try:
+            response = super().send(request, **kwargs)
+        except RateLimitTimeout:
+            breaker.release_trial()  # Not an upstream failure
+            raise
+        except requests.exceptions.RequestException:
+            breaker.record_failure(host)
+            raise
+        if response.status_code == 429 or response.status_code >= 500:
+            breaker.record_failure(host)
+        else:
+            breaker.record_success()
+        return response
@@ -0,0 +1,3 @@
+SECRET_KEY = 'x'
+FROM_ADDRESS = 'noreply@albumscrobbles.com'
+LASTFM_API_KEY = ''
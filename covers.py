@@ -0,0 +1,71 @@
+# Resized variants of the cover images, in WebP for browsers that accept it and JPEG for the others.
+# Every variant is made once and kept in the binary cache next to the original.
+# Needs Pillow, see setup/requirements.in. Without it the original covers are served.
+import io
+import os
+from collections import Counter
+from typing import Optional, Tuple
+
+from file_cache import binary_file_cache_decorator
+from scrape import cache_binary_url_and_return_path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SIZES = (64, 150, 300)  # px
+MIMETYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+QUALITY = 80
+
+# Bytes of the originals versus the bytes of what was served, and the pages that show covers. Per process.
+COVER_STATS = Counter()
+
+
+def pick_format(accept: str) -> str:
+    return "webp" if "image/webp" in (accept or "") else "jpeg"
+
+
+def make_variant(image_bytes: bytes, size: int, fmt: str) -> bytes:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.save(out, format=fmt.upper(), quality=QUALITY)
+        return out.getvalue()
+
+
+@binary_file_cache_decorator(return_path=True)
+def cache_cover_variant(url: str, size: str, fmt: str) -> bytes:
+    with open(cache_binary_url_and_return_path(url), "rb") as f:
+        return make_variant(f.read(), int(size), fmt)
+
+
+def get_cover_path(url: str, size: Optional[int] = None, fmt: str = "jpeg") -> Tuple[str, Optional[str]]:
+    # (path, mimetype) of the cover in the requested size. The original (with mimetype None) when no known
+    # size is requested, Pillow is not installed or the image can not be converted.
+    original = cache_binary_url_and_return_path(url)
+    path, mimetype = original, None
+    if size in SIZES and Image is not None:
+        try:
+            path, mimetype = cache_cover_variant(url, str(size), fmt), MIMETYPES[fmt]
+        except Exception as e:
+            print(f"Could not make a {size}px {fmt} variant of {url}: {e!r}")
+    COVER_STATS["covers"] += 1
+    COVER_STATS["original_bytes"] += os.stat(original).st_size
+    COVER_STATS["served_bytes"] += os.stat(path).st_size
+    return path, mimetype
+
+
+def record_page_view():
+    COVER_STATS["pages"] += 1
+
+
+def get_cover_stats():
+    saved = COVER_STATS["original_bytes"] - COVER_STATS["served_bytes"]
+    return dict(
+        COVER_STATS,
+        pillow=Image is not None,
+        saved_bytes=saved,
+        saved_bytes_per_page=COVER_STATS["pages"] and saved // COVER_STATS["pages"],
+    )
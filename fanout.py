@@ -0,0 +1,79 @@
+# Runs a function for a batch of items on a bounded thread pool and collects the results in the original order.
+import contextvars
+import os
+import threading
+from os import getenv
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+FANOUT_DEADLINE = 20  # seconds. Return partial results well before the gunicorn worker timeout.
+# Separate pools, so a task running on one pool can fan out on another one without exhausting it.
+POOL_SIZES = {
+    "album_details": 20,
+    # Periods of an overview page. Every period already fans out to many weekly charts, and all requests
+    # share the last.fm rate limiter, so a few parallel periods are enough. Set with OVERVIEW_CONCURRENCY.
+    "overview": int(getenv("OVERVIEW_CONCURRENCY") or 6),
+}
+
+# Set to a list per request. Functions whose results were left incomplete are appended, so the response
+# is not cached.
+served_partial = contextvars.ContextVar("served_partial", default=None)
+
+_executors = dict()
+_executors_lock = threading.Lock()
+
+
+def get_executor(pool: str) -> ThreadPoolExecutor:
+    # Created lazily per process, threads do not survive a fork.
+    with _executors_lock:
+        key = (pool, os.getpid())
+        if key not in _executors:
+            _executors[key] = ThreadPoolExecutor(max_workers=POOL_SIZES[pool], thread_name_prefix=pool)
+        return _executors[key]
+
+
+class Results(list):
+    # complete is False when items were left out, so callers can avoid caching partial results.
+    complete = True
+
+
+def ordered_map(func: Callable, items: Iterable, pool: str, deadline: Optional[float] = FANOUT_DEADLINE) -> Results:
+    # Results are in the order of items. Items that fail or are not done before the deadline are left out.
+    # With deadline=None it waits for every item.
+    # Calls that are still running are not cancelled, so they can still fill the cache for the next request.
+    executor = get_executor(pool)
+    # Run in a copy of the caller's context, so context vars like file_cache.served_stale are visible.
+    futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+    done, not_done = wait(futures, timeout=deadline)
+    results = Results()
+    for future in futures:
+        if future not in done:
+            continue
+        if e := future.exception():
+            print(f"Failed {func.__name__}: {e!r}")
+            results.complete = False
+            continue
+        results.append(future.result())
+    if not_done:
+        results.complete = False
+        print(f"Deadline of {deadline}s passed for {func.__name__}. Returning {len(results)} of {len(futures)} results.")
+    if not results.complete and (partial := served_partial.get()) is not None:
+        partial.append(func.__name__)
+    return results
+
+
+def completed_map(func: Callable, items: Iterable, pool: str, deadline: float = FANOUT_DEADLINE) -> Iterator[Tuple]:
+    # Yields (item, result) as soon as each call is done, so results can be streamed to the client.
+    # Like ordered_map, items that fail or are not done before the deadline are left out.
+    executor = get_executor(pool)
+    futures = {executor.submit(contextvars.copy_context().run, func, item): item for item in items}
+    done = 0
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            if e := future.exception():
+                print(f"Failed {func.__name__}: {e!r}")
+                continue
+            done += 1
+            yield futures[future], future.result()
+    except TimeoutError:
+        print(f"Deadline of {deadline}s passed for {func.__name__}. Returned {done} of {len(futures)} results.")
@@ -1,11 +1,27 @@
 # Simple file cache for functions that return a string
 # By Apie
 # 2020-12-05
+import fcntl
+import inspect
+import json
 import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
 
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from requests.exceptions import RequestException
+
+from cache_backends import CacheMiss, FileBackend, SqliteBackend
+from memory_cache import MemoryTier
+from sqlite_util import LocalConnection
+
 try:
     # Local cache used for testing. To use it, create this subdir.
     SUBDIR = Path(os.path.dirname(__file__)) / Path("cache")
@@ -14,49 +30,388 @@ except AssertionError:
     # Default cache location
     SUBDIR = Path("/tmp/albumscrobbles")
 
+SQLITE_FILENAME = "cache.sqlite"
+LOCK_DIR = SUBDIR / Path(".locks")
+LOCK_STRIPES = 1024  # Keys share a fixed number of lock files per function, so locks do not add an inode per key
+SINGLE_FLIGHT_TIMEOUT = 30  # seconds. Stay well below the gunicorn worker timeout.
+
+GENERATION_DIR = SUBDIR / Path(".generations")
+MEMORY_MAX_BYTES = 10 * 1024 * 1024
+FRAGMENT_MEMORY_ENTRIES = 1000
+
+# keep_days (including any stale window) per decorated function, so the janitor knows what is expired.
+NAMESPACES = {}
+MEMORY_TIERS = {}
+# Hits and misses per function and tier, for this process.
+CACHE_STATS = defaultdict(Counter)
+# Set to a list per request. Functions that served an expired value because upstream failed are appended.
+served_stale = ContextVar("served_stale", default=None)
+# While an expired entry is recomputed: a dict with the upstream validators (etag, last_modified) of that entry.
+# http_client.conditional_get sends them and fills in the validators of a new response.
+revalidating = ContextVar("revalidating", default=None)
+
+validators_connection = LocalConnection(SUBDIR / "validators.sqlite", schema=(
+    "CREATE TABLE IF NOT EXISTS validators ("
+    " func_name TEXT NOT NULL,"
+    " key TEXT NOT NULL,"
+    " etag TEXT,"
+    " last_modified TEXT,"
+    " PRIMARY KEY (func_name, key)"
+    ")",
+))
+
+
+def get_backend(name=None):
+    # Select the storage engine with the CACHE_BACKEND env var: 'file' (default) or 'sqlite'.
+    name = name or os.getenv("CACHE_BACKEND") or "file"
+    if name == "file":
+        return FileBackend(SUBDIR)
+    if name == "sqlite":
+        return SqliteBackend(SUBDIR / SQLITE_FILENAME)
+    raise ValueError(f"Unknown cache backend {name=}")
+
+
+backend = get_backend()
+
+
+NONE_ARG = "\x1e"  # Stands for None in a key, so f(None) and f("") get different keys
+
+
+def make_key(*args):
+    # Unambiguous key for the arguments. Empty arguments are kept, so f("a", "", "b") and f("a", "b") differ.
+    # Backends that need a filename hash it.
+    return "\x1f".join(NONE_ARG if arg is None else arg for arg in args) or "empty"
+
 
 def get_filename(*args):
+    # Key of the old flat file layout. Only used to find entries that were cached before the hashed layout.
     # Truncate filename to a max length
     filename = "-".join(arg.replace("/", "-") for arg in args if arg)[:200]
     return filename or "empty"
 
 
-def get_from_cache(*args, func_name, keep_days=None) -> str:
-    filename = SUBDIR / Path(f"{func_name}/{get_filename(*args)}")
+def is_expired(updated: float, keep_days=None) -> bool:
+    return bool(
+        keep_days and datetime.fromtimestamp(updated) + timedelta(days=keep_days) < datetime.now()
+    )
+
+
+class CacheExpired(CacheMiss):
+    # Raised instead of removing an expired entry, so the value can still be served when upstream is down.
+    def __init__(self, filename, value):
+        super().__init__(filename)
+        self.value = value
+
+
+def get_entry_from_cache(
+    *args, func_name, keep_days=None, stale_days=None, backend=None, binary=False, keep_expired=False,
+    keep_days_for=None
+):
+    # Returns (value, is_stale, expires). Entries that expired less than stale_days ago are returned as stale,
+    # older entries are removed (or raised as CacheExpired with keep_expired).
+    # keep_days_for(value, *args) can return a different keep_days for a specific cached value.
+    backend = backend or globals()["backend"]
+    key = make_key(*args)
     # print(f"Getting {func_name} from file cache: {args} {keep_days}")
-    if (
-        keep_days and datetime.fromtimestamp(filename.stat().st_mtime) + timedelta(days=keep_days) < datetime.now()
-    ):
+    entry = backend.get(func_name, key, binary=binary, legacy_key=get_filename(*args))
+    if keep_days_for:
+        keep_days = keep_days_for(entry.value, *args) or keep_days
+    if is_expired(entry.updated, keep_days):
+        if stale_days and not is_expired(entry.updated, keep_days + stale_days):
+            return entry.value, True, None
+        if keep_expired:
+            raise CacheExpired(f"{func_name}/{key}", entry.value)
         print(f"Cache expired. Removing file. {func_name} {args}")
-        os.remove(filename)
-    with open(filename) as f:
-        # print(f'Found in cache {func_name} {args}')
-        return f.read()
+        backend.delete(func_name, key)
+        raise CacheMiss(f"{func_name}/{key}")
+    # print(f'Found in cache {func_name} {args}')
+    return entry.value, False, keep_days and entry.updated + keep_days * 24 * 3600
+
+
+def get_from_cache(*args, func_name, keep_days=None, backend=None) -> str:
+    value, _is_stale, _expires = get_entry_from_cache(*args, func_name=func_name, keep_days=keep_days, backend=backend)
+    return value
 
 
-def update_cache(*args, func_name, result: str):
+def update_cache(*args, func_name, result: str, keep_days=None, backend=None):
     assert isinstance(
         result, str
     ), f"Cache can only be used for string results! Not for {type(result)}"
+    backend = backend or globals()["backend"]
     # print(f"Updating {func_name} in file cache: {args} {result}")
-    path = SUBDIR / Path(func_name)
-    path.mkdir(parents=True, exist_ok=True)
-    with open(path / Path(get_filename(*args)), "w") as f:
-        f.write(result)
+    backend.set(func_name, make_key(*args), result, keep_days=keep_days)
+
+
+class Uncacheable(Exception):
+    # Raised by a cached function to return a value without caching it, eg. results that are partial
+    # because a deadline passed.
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+
+class NotModified(Exception):
+    # Upstream answered a conditional request with 304, so the expired value is still current.
+    pass
+
+
+def get_validators(func_name, key) -> dict:
+    row = validators_connection().execute(
+        "SELECT etag, last_modified FROM validators WHERE func_name = ? AND key = ?", (func_name, key)
+    ).fetchone()
+    return dict(etag=row[0], last_modified=row[1]) if row else dict()
+
+
+def save_validators(func_name, key, validators: dict):
+    if validators.get("etag") or validators.get("last_modified"):
+        validators_connection().execute(
+            "INSERT OR REPLACE INTO validators (func_name, key, etag, last_modified) VALUES (?, ?, ?, ?)",
+            (func_name, key, validators.get("etag"), validators.get("last_modified")),
+        )
+    else:
+        validators_connection().execute("DELETE FROM validators WHERE func_name = ? AND key = ?", (func_name, key))
+
+
+def call_revalidating(func, *args, func_name, has_value=False):
+    # Calls func(*args) and stores the validators of the upstream response. When there is a cached value
+    # (has_value), its validators are sent along and None is returned when upstream says it did not change.
+    key = make_key(*args)
+    validators = get_validators(func_name, key) if has_value else dict()
+    token = revalidating.set(validators)
+    try:
+        result = func(*args)
+    except NotModified:
+        print(f"Not modified upstream. Renewing cache entry. {func_name} {args}")
+        CACHE_STATS[func_name]["not_modified"] += 1
+        return None
+    finally:
+        revalidating.reset(token)
+    if has_value or validators:
+        save_validators(func_name, key, validators)
+    return result
+
+
+@contextmanager
+def key_lock(func_name, key, timeout=SINGLE_FLIGHT_TIMEOUT):
+    # Cross-process lock per key. Yields True when the lock was acquired, False after the timeout.
+    lock_path = LOCK_DIR / Path(func_name)
+    lock_path.mkdir(parents=True, exist_ok=True)
+    stripe = zlib.crc32(key.encode("utf-8")) % LOCK_STRIPES
+    with open(lock_path / Path(str(stripe)), "a") as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    print(f"Timeout waiting for lock. {func_name} {key}")
+                    yield False
+                    return
+                time.sleep(0.05)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_updated(*args, func_name, backend=None):
+    # Update timestamp of the cached entry, or None. Used as a cheap version of the cached data.
+    backend = backend or globals()["backend"]
+    return backend.updated(func_name, make_key(*args))
 
 
-def file_cache_decorator(keep_days=None):
+def get_generation(func_name) -> str:
+    # Changes every time func_name is invalidated.
+    try:
+        return (GENERATION_DIR / Path(func_name)).read_text()
+    except FileNotFoundError:
+        return "0"
+
+
+def invalidate(func_name):
+    # Drop the memory tier of func_name in every process, eg. after the file cache was edited by apply_corrections.py.
+    GENERATION_DIR.mkdir(parents=True, exist_ok=True)
+    (GENERATION_DIR / Path(func_name)).write_text(str(time.time()))
+    if func_name in MEMORY_TIERS:
+        MEMORY_TIERS[func_name].clear()
+
+
+def get_cache_stats():
+    stats = dict()
+    for func_name, counter in sorted(CACHE_STATS.items()):
+        stats[func_name] = dict(counter)
+        for tier in ("memory", "disk"):
+            lookups = counter[f"{tier}_hit"] + counter[f"{tier}_miss"]
+            if lookups:
+                stats[func_name][f"{tier}_hit_rate"] = round(counter[f"{tier}_hit"] / lookups, 3)
+        if func_name in MEMORY_TIERS:
+            tier = MEMORY_TIERS[func_name]
+            stats[func_name]["memory_entries"] = len(tier.entries)
+            stats[func_name]["memory_bytes"] = tier.size
+    return stats
+
+
+# Keys that are being refreshed in the background by this process.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(func, *args, keep_days=None, backend=None):
+    # Start a single background refresh per key. When it fails the stale entry is kept.
+    refresh_key = (func.__name__, make_key(*args))
+    with _refreshing_lock:
+        if refresh_key in _refreshing:
+            return
+        _refreshing.add(refresh_key)
+
+    def refresh():
+        try:
+            # Also a single refresh across processes. Skip it when another process is already computing this key.
+            with key_lock(func.__name__, make_key(*args), timeout=0) as acquired:
+                if not acquired:
+                    return
+                updated = get_updated(*args, func_name=func.__name__, backend=backend)
+                if updated and not is_expired(updated, keep_days):
+                    return  # Refreshed by another process in the meantime
+                result = call_revalidating(func, *args, func_name=func.__name__, has_value=True)
+                if result is None:
+                    (backend or globals()["backend"]).touch(func.__name__, make_key(*args), keep_days)
+                    return
+                update_cache(*args, func_name=func.__name__, result=result, keep_days=keep_days, backend=backend)
+        except Uncacheable:
+            pass  # Keep the stale entry until a complete value can be computed
+        except Exception as e:
+            print(f"Background refresh failed. Keeping stale entry. {func.__name__} {args}: {e!r}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(refresh_key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def file_cache_decorator(
+    keep_days=None, backend=None, stale_while_revalidate=None, single_flight=False, memory_max_entries=None,
+    keep_days_for=None, refresh_stale=True
+):
+    # keep_days_for: function (value, *args) returning keep_days for a specific result, eg. a short one for fallbacks.
+    # stale_while_revalidate: number of days after keep_days during which the stale value is returned
+    # immediately while it is refreshed in the background.
+    # refresh_stale: False when a background job replaces the stale values, then they are only served.
+    # single_flight: on a miss only one process computes the value, the others wait for it and read it from the cache.
+    # memory_max_entries: keep up to this many (and at most MEMORY_MAX_BYTES) recently used values in process memory.
     def inner(func):
+        func_name = func.__name__
+        NAMESPACES[func_name] = keep_days and keep_days + (stale_while_revalidate or 0)
+        stats = CACHE_STATS[func_name]
+        memory = None
+        if memory_max_entries:
+            memory = MEMORY_TIERS[func_name] = MemoryTier(
+                memory_max_entries, MEMORY_MAX_BYTES, generation_file=GENERATION_DIR / Path(func_name)
+            )
+
+        def compute(*args, expired_value=None):
+            try:
+                result = call_revalidating(func, *args, func_name=func_name, has_value=expired_value is not None)
+            except Uncacheable as e:
+                stats["uncacheable"] += 1
+                return e.value
+            if result is None:
+                # Same as the expired value
+                (backend or globals()["backend"]).touch(func_name, make_key(*args), keep_days)
+                result = expired_value
+            else:
+                update_cache(*args, func_name=func_name, result=result, keep_days=keep_days, backend=backend)
+            if memory:
+                result_keep_days = (keep_days_for and keep_days_for(result, *args)) or keep_days
+                memory.set(make_key(*args), result, result_keep_days and time.time() + result_keep_days * 24 * 3600)
+            return result
+
         @wraps(func)
         def wrapper(*args, **kwargs):
+            if memory:
+                try:
+                    value = memory.get(make_key(*args))
+                    stats["memory_hit"] += 1
+                    return value
+                except KeyError:
+                    stats["memory_miss"] += 1
+            expired_value = None
             try:
-                return get_from_cache(
-                    *args, **kwargs, func_name=func.__name__, keep_days=keep_days
+                value, is_stale, expires = get_entry_from_cache(
+                    *args, **kwargs, func_name=func_name, keep_days=keep_days,
+                    stale_days=stale_while_revalidate, backend=backend, keep_expired=True, keep_days_for=keep_days_for
                 )
-            except (FileNotFoundError, IsADirectoryError):
-                result = func(*args, **kwargs)
-                update_cache(*args, **kwargs, func_name=func.__name__, result=result)
-                return result
+                stats["disk_hit"] += 1
+                if is_stale:
+                    # Never kept in memory, so the refreshed value on disk is seen by every process.
+                    if refresh_stale:
+                        refresh_in_background(func, *args, keep_days=keep_days, backend=backend)
+                elif memory:
+                    memory.set(make_key(*args), value, expires)
+                return value
+            except CacheExpired as e:
+                stats["disk_miss"] += 1
+                expired_value = e.value
+            except FileNotFoundError:
+                stats["disk_miss"] += 1
+            try:
+                if not single_flight:
+                    return compute(*args, expired_value=expired_value)
+                with key_lock(func_name, make_key(*args)) as acquired:
+                    if acquired:
+                        try:
+                            # Another process may have computed it while we were waiting for the lock.
+                            value, _is_stale, _expires = get_entry_from_cache(
+                                *args, **kwargs, func_name=func_name, keep_days=keep_days,
+                                backend=backend, keep_expired=True, keep_days_for=keep_days_for
+                            )
+                            return value
+                        except FileNotFoundError:
+                            pass
+                    return compute(*args, expired_value=expired_value)
+            except RequestException as e:
+                if expired_value is None:
+                    raise
+                # Upstream is down. Serve the most recent value, even though it is past keep_days.
+                print(f"Serving expired entry. {func_name} {args}: {e!r}")
+                stats["served_expired"] += 1
+                if (served := served_stale.get()) is not None:
+                    served.append(func_name)
+                return expired_value
+
+        return wrapper
+
+    return inner
+
+
+def fragment_cache_decorator(keep_days, keep_days_for=None, memory_max_entries=FRAGMENT_MEMORY_ENTRIES, backend=None):
+    # Cache for rendered fragments (and other small results) shared by all workers, in the namespace
+    # fragment_<function name>. Arguments and result can be anything that can be dumped to json.
+    # keep_days_for(result) can return a different keep_days for a specific result, eg. an empty fragment.
+    def inner(func):
+        signature = inspect.signature(func)
+
+        def render(*json_args):
+            try:
+                return json.dumps(func(*(json.loads(arg) for arg in json_args)))
+            except Uncacheable as e:
+                raise Uncacheable(json.dumps(e.value))
+
+        render.__name__ = f"fragment_{func.__name__}"
+        cached = file_cache_decorator(
+            keep_days=keep_days,
+            backend=backend,
+            memory_max_entries=memory_max_entries,
+            keep_days_for=keep_days_for and (lambda value, *_args: keep_days_for(json.loads(value))),
+        )(render)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # Keyword and default arguments are bound, so every call for the same fragment has the same key.
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return json.loads(cached(*(json.dumps(arg) for arg in bound.args)))
 
         return wrapper
 
@@ -66,45 +421,54 @@ def file_cache_decorator(keep_days=None):
 #  ###### BINARY cache #######
 
 
-def get_from_binary_cache(*args, func_name, keep_days=None) -> bytes:
-    filename = SUBDIR / Path(f"{func_name}/{get_filename(*args)}")
-    # print(f"Getting {func_name} from file cache: {args} {keep_days}")
-    if (
-        keep_days and datetime.fromtimestamp(filename.stat().st_mtime) + timedelta(days=keep_days) < datetime.now()
-    ):
-        print(f"Cache expired. Removing file. {func_name} {args}")
-        os.remove(filename)
-    with open(filename, "rb") as f:
-        # print(f'Found in cache {func_name} {args}')
-        return f.read()
+def get_from_binary_cache(*args, func_name, keep_days=None, backend=None) -> bytes:
+    value, _is_stale, _expires = get_entry_from_cache(
+        *args, func_name=func_name, keep_days=keep_days, backend=backend, binary=True
+    )
+    return value
 
 
-def update_binary_cache(*args, func_name, result: bytes):
+def update_binary_cache(*args, func_name, result: bytes, keep_days=None, backend=None):
     assert isinstance(
         result, bytes
     ), f"Cache can only be used for bytes results! Not for {type(result)}"
+    backend = backend or globals()["backend"]
     # print(f"Updating {func_name} in file cache: {args}")
-    path = SUBDIR / Path(func_name)
-    path.mkdir(parents=True, exist_ok=True)
-    with open(path / Path(get_filename(*args)), "wb") as f:
-        f.write(result)
+    backend.set(func_name, make_key(*args), result, keep_days=keep_days)
 
 
-def binary_file_cache_decorator(keep_days=None, return_path=False):
+def binary_file_cache_decorator(keep_days=None, return_path=False, backend=None):
     def inner(func):
+        NAMESPACES[func.__name__] = keep_days
         @wraps(func)
-        def wrapper(*args, **kwargs):
+        def wrapper(*args):
+            # Returning a path needs a real file, so those entries always live in the directory layout.
+            _backend = backend or globals()["backend"]
+            if return_path and not hasattr(_backend, "path"):
+                _backend = FileBackend(SUBDIR)
+            if return_path:
+                # Only the path is needed, so do not read the file. Expired entries are read below to revalidate them.
+                updated = _backend.stat(func.__name__, make_key(*args))
+                if updated and not is_expired(updated, keep_days):
+                    return _backend.path(func.__name__, make_key(*args))
             try:
-                result = get_from_binary_cache(
-                    *args, **kwargs, func_name=func.__name__, keep_days=keep_days
-                )
-            except (FileNotFoundError, IsADirectoryError):
-                result = func(*args, **kwargs)
-                update_binary_cache(
-                    *args, **kwargs, func_name=func.__name__, result=result
+                result, _is_stale, _expires = get_entry_from_cache(
+                    *args, func_name=func.__name__, keep_days=keep_days, backend=_backend, binary=True,
+                    keep_expired=True
                 )
+            except FileNotFoundError as e:
+                expired_value = e.value if isinstance(e, CacheExpired) else None
+                result = call_revalidating(func, *args, func_name=func.__name__, has_value=expired_value is not None)
+                if result is None:
+                    # Same as the expired value
+                    _backend.touch(func.__name__, make_key(*args), keep_days)
+                    result = expired_value
+                else:
+                    update_binary_cache(
+                        *args, func_name=func.__name__, result=result, keep_days=keep_days, backend=_backend
+                    )
             if return_path:
-                return SUBDIR / Path(f"{func.__name__}/{get_filename(*args)}")
+                return _backend.path(func.__name__, make_key(*args))
             return result
 
         return wrapper
@@ -0,0 +1,73 @@
+# Conditional requests. ETags are derived from the version of the cached data a page is rendered from,
+# so a matching request is answered with 304 before any template is rendered.
+import hashlib
+import os
+from datetime import date, datetime, timezone
+from typing import Callable, Optional
+
+from flask import make_response, request
+
+from fanout import served_partial
+from file_cache import get_generation
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+DAY_MAX_AGE = 3600  # seconds. For pages that are versioned per day.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def get_template_version() -> str:
+    # Changes on every deploy that touches a template. The same in every worker.
+    return str(max(
+        os.stat(os.path.join(root, name)).st_mtime for root, _dirs, files in os.walk(TEMPLATE_DIR) for name in files
+    ))
+
+
+TEMPLATE_VERSION = get_template_version()
+
+
+def make_etag(*parts) -> str:
+    # Pages also change when corrections are applied to the album details or a template changes.
+    parts = (*parts, get_generation("_get_album_details"), TEMPLATE_VERSION)
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+
+
+def day_etag(*parts) -> str:
+    # For pages that are assembled from many cached entries. They are considered changed once a day.
+    return make_etag(*parts, date.today().isoformat())
+
+
+def max_age_for(updated: float, keep_days: Optional[float]) -> int:
+    # Until the cached data expires
+    if not keep_days:
+        return IMMUTABLE_MAX_AGE
+    return max(0, int(updated + keep_days * 24 * 3600 - datetime.now().timestamp()))
+
+
+def conditional_response(
+    render: Callable, etag: Optional[str], max_age: int = 0, last_modified: Optional[float] = None,
+    immutable: bool = False
+):
+    # render() is only called when the client does not have this version yet. Without an etag it always is.
+    # A page that misses results, or is streamed before they are known, is not stored and gets no etag.
+    if etag is None:
+        return render()
+    modified = last_modified and datetime.fromtimestamp(int(last_modified), timezone.utc)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = bool(modified and request.if_modified_since and request.if_modified_since >= modified)
+    if not_modified:
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+        if response.is_streamed or served_partial.get():
+            response.cache_control.no_store = True
+            return response
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,103 @@
+# The HTTP client shared by all upstream calls: one session with connection pools per host that are large
+# enough for the fan-out pools, the last.fm rate limiter and circuit breaker, and stats per host.
+import threading
+import time
+import weakref
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+import requests
+from urllib3.util import make_headers
+
+from circuitbreaker import CircuitBreakerAdapter
+from fanout import POOL_SIZES
+from file_cache import NotModified, revalidating
+
+POOL_CONNECTIONS = 10  # Number of hosts to keep a pool for
+# Every fan-out thread can have a request in flight, plus the request threads of the worker.
+POOL_MAXSIZE = sum(POOL_SIZES.values()) + 4
+MAX_RETRIES = 3
+
+# Per host and per process
+HTTP_STATS = defaultdict(Counter)
+_stats_lock = threading.Lock()
+_seen_connections = weakref.WeakKeyDictionary()
+
+
+class TimedAdapter(requests.adapters.HTTPAdapter):
+    # Innermost adapter: measures the time to the response headers and whether a connection was reused,
+    # without the time spent waiting for the rate limiter.
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)  # Returns when the headers are received
+        ttfb = time.perf_counter() - start
+        pool = getattr(response.raw, "_pool", None)
+        with _stats_lock:
+            stats = HTTP_STATS[host]
+            stats["requests"] += 1
+            if pool is not None:
+                # Connections the pool opened since the previous request
+                stats["new_connections"] += pool.num_connections - _seen_connections.get(pool, 0)
+                _seen_connections[pool] = pool.num_connections
+            stats["ttfb_seconds"] += ttfb
+            stats["max_ttfb_ms"] = max(stats["max_ttfb_ms"], int(ttfb * 1000))
+        return response
+
+
+class ClientAdapter(CircuitBreakerAdapter, TimedAdapter):
+    # Circuit breaker, then rate limiter, then the timed request.
+    pass
+
+
+class HttpsSession(requests.Session):
+    # All upstream hosts support https. Upgrade plain http urls (eg. from scraped pages) instead of following a redirect.
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith("http://"):
+            url = "https://" + url[len("http://"):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def make_session() -> requests.Session:
+    s = HttpsSession()
+    adapter = ClientAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    # gzip and deflate, and br with the brotli package from the requirements. Connections are kept alive by the pools.
+    s.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    return s
+
+
+session = make_session()
+
+
+def conditional_get(url: str, **kwargs) -> requests.Response:
+    # GET for a function that is cached with file_cache. When it recomputes an expired entry, the validators of
+    # that entry are sent and NotModified is raised on a 304, so the cache can renew the entry instead.
+    validators = revalidating.get()
+    headers = dict(kwargs.pop("headers", None) or {})
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    response = session.get(url, headers=headers, **kwargs)
+    if response.status_code == 304 and validators:
+        raise NotModified(url)
+    if validators is not None and response.ok:
+        validators["etag"] = response.headers.get("ETag")
+        validators["last_modified"] = response.headers.get("Last-Modified")
+    return response
+
+
+def get_http_stats():
+    with _stats_lock:
+        return {
+            host: dict(
+                stats,
+                reuse_rate=round(1 - stats["new_connections"] / stats["requests"], 3),
+                avg_ttfb_ms=int(stats["ttfb_seconds"] / stats["requests"] * 1000),
+            )
+            for host, stats in HTTP_STATS.items()
+            if stats["requests"]
+        }
@@ -0,0 +1,64 @@
+# Bounded in-process LRU cache used as the first tier in front of the file cache.
+import os
+import threading
+import time
+from collections import OrderedDict
+
+GENERATION_CHECK_INTERVAL = 5  # seconds between checks for invalidations by other processes
+
+
+class MemoryTier:
+    def __init__(self, max_entries, max_bytes, generation_file=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Other processes (eg. apply_corrections.py) touch this file to invalidate all memory tiers of a function.
+        self.generation_file = generation_file
+        self.generation = None
+        self.generation_checked = 0
+        self.entries = OrderedDict()  # key: (value, expires)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Raises KeyError when the key is not cached or expired.
+        self.check_generation()
+        with self.lock:
+            value, expires = self.entries[key]
+            if expires and expires < time.time():
+                self._remove(key)
+                raise KeyError(key)
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires=None):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, expires)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        value, _expires = self.entries.pop(key)
+        self.size -= len(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def check_generation(self):
+        if not self.generation_file or time.monotonic() - self.generation_checked < GENERATION_CHECK_INTERVAL:
+            return
+        self.generation_checked = time.monotonic()
+        try:
+            generation = os.stat(self.generation_file).st_mtime
+        except FileNotFoundError:
+            generation = 0
+        if self.generation is not None and generation != self.generation:
+            self.clear()
+        self.generation = generation
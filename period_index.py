@@ -0,0 +1,87 @@
+# Per user index of the weekly charts that are known, and how many albums they have.
+# Lets blast from the past pick a period that has scrobbles and whose charts are all cached already.
+import json
+import threading
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import charts
+from file_cache import SUBDIR, get_from_cache, key_lock
+from ratelimit import in_background
+from sqlite_util import LocalConnection
+
+connection = LocalConnection(SUBDIR / "period_index.sqlite", schema=(
+    "CREATE TABLE IF NOT EXISTS weeks ("
+    " user TEXT NOT NULL,"
+    " start INTEGER NOT NULL,"
+    " end INTEGER NOT NULL,"
+    " albums INTEGER NOT NULL,"
+    " PRIMARY KEY (user, start)"
+    ")",
+    # Users whose weekly charts cached before this index existed have been added.
+    "CREATE TABLE IF NOT EXISTS scanned (user TEXT PRIMARY KEY)",
+))
+
+
+def record_week(username: str, start: int, end: int, albums: int):
+    connection().execute(
+        "INSERT OR REPLACE INTO weeks (user, start, end, albums) VALUES (?, ?, ?, ?)", (username, start, end, albums)
+    )
+
+
+def scan_cache(username: str):
+    # One-off per user: add the weekly charts that are in the cache but not in the index. Does not call last.fm.
+    conn = connection()
+    known = {row[0] for row in conn.execute("SELECT start FROM weeks WHERE user = ?", (username,))}
+    now = datetime.now().timestamp()
+    chart_list = json.loads(charts.get_weekly_chart_list(username))
+    conn.execute("BEGIN")
+    for start, end in chart_list:
+        if start in known or end > now:
+            continue
+        try:
+            chart = get_from_cache(username, str(start), str(end), func_name="get_weekly_album_chart")
+        except FileNotFoundError:
+            continue
+        record_week(username, start, end, len(json.loads(chart)))
+    conn.execute("INSERT OR IGNORE INTO scanned (user) VALUES (?)", (username,))
+    conn.execute("COMMIT")
+
+
+def get_week_index(username: str) -> Dict[Tuple[int, int], int]:
+    # {(start, end): number of albums} for every week whose chart is cached.
+    conn = connection()
+    if not conn.execute("SELECT 1 FROM scanned WHERE user = ?", (username,)).fetchone():
+        scan_cache(username)
+    return {
+        (start, end): albums
+        for start, end, albums in conn.execute("SELECT start, end, albums FROM weeks WHERE user = ?", (username,))
+    }
+
+
+def get_weeks_since_registered(username: str) -> List[Tuple[int, int]]:
+    # The chart list of last.fm also has the weeks before the user created the account. Those are always empty.
+    from scrape import get_username_registered
+    registered = get_username_registered(username)
+    return [(start, end) for start, end in json.loads(charts.get_weekly_chart_list(username)) if end > registered]
+
+
+def index_in_background(username: str):
+    # Fetch every weekly chart of a user that has none indexed yet. Off the request path, one worker at a time.
+    def run():
+        # On the background budget of the rate limiter, so interactive requests keep most of it.
+        with key_lock("period_index", username, timeout=0) as acquired, in_background():
+            if not acquired:
+                return
+            index = get_week_index(username)
+            now = datetime.now().timestamp()
+            for start, end in get_weeks_since_registered(username):
+                if (start, end) in index or end > now:
+                    continue
+                try:
+                    charts.get_weekly_album_chart(username, str(start), str(end))
+                except Exception as e:
+                    print(f"Indexing weeks of {username} stopped: {e!r}")
+                    return
+
+    threading.Thread(target=run, daemon=True).start()
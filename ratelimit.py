@@ -0,0 +1,171 @@
+# Token bucket rate limiter for outgoing requests, shared by all worker processes through a SQLite database.
+# Responses with status 429 or 5xx make every process back off from that host for a while.
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlparse
+
+import requests
+
+from file_cache import SUBDIR
+from sqlite_util import LocalConnection
+
+Budget = namedtuple("Budget", "rate burst")  # tokens per second, bucket size
+RATE_LIMITS = {
+    "ws.audioscrobbler.com": Budget(rate=5, burst=10),
+    "www.last.fm": Budget(rate=2, burst=5),
+    "lastfm.freetls.fastly.net": Budget(rate=20, burst=40),
+}
+# Jobs that download a complete history take a token from their own, smaller bucket as well, so they can never
+# use more than this part of the budget of the host and interactive requests keep the rest.
+BACKGROUND_RATE_LIMITS = {
+    "ws.audioscrobbler.com": Budget(rate=1, burst=2),
+}
+MAX_WAIT = 10  # seconds. Give up waiting for a token after this.
+MIN_BACKOFF = 2  # seconds
+MAX_BACKOFF = 120  # seconds
+
+
+class RateLimitTimeout(requests.exceptions.ConnectionError):
+    # A ConnectionError, so callers handle it like an unreachable upstream.
+    pass
+
+
+class RateLimiter:
+    def __init__(self, filename, limits):
+        self.limits = limits
+        self.connection = LocalConnection(filename, schema=(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " host TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " blocked_until REAL NOT NULL DEFAULT 0,"
+            " backoff REAL NOT NULL DEFAULT 0"
+            ")",
+        ))
+        # Per process metrics
+        self.stats = defaultdict(Counter)
+
+    def _bucket(self, conn, host, budget, now):
+        row = conn.execute(
+            "SELECT tokens, updated, blocked_until, backoff FROM buckets WHERE host = ?", (host,)
+        ).fetchone()
+        if row is None:
+            return budget.burst, 0, 0
+        tokens, updated, blocked_until, backoff = row
+        return min(budget.burst, tokens + (now - updated) * budget.rate), blocked_until, backoff
+
+    def acquire(self, host):
+        budget = self.limits.get(host)
+        if not budget:
+            return
+        conn = self.connection()
+        start = time.monotonic()
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, blocked_until, backoff = self._bucket(conn, host, budget, now)
+                if now >= blocked_until and tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = max(blocked_until - now, (1 - tokens) / budget.rate)
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (host, tokens, updated, blocked_until, backoff) VALUES (?, ?, ?, ?, ?)",
+                    (host, tokens, now, blocked_until, backoff),
+                )
+            finally:
+                conn.execute("COMMIT")
+            waited = time.monotonic() - start
+            if not wait:
+                self.stats[host]["acquired"] += 1
+                self.stats[host]["waited_seconds"] += waited
+                self.stats[host]["max_wait_seconds"] = max(self.stats[host]["max_wait_seconds"], waited)
+                return
+            if waited + wait > MAX_WAIT:
+                self.stats[host]["timeouts"] += 1
+                raise RateLimitTimeout(f"No token for {host} within {MAX_WAIT}s")
+            time.sleep(wait)
+
+    def report(self, host, status_code, retry_after=None):
+        # Back off exponentially on 429/5xx, reset after a successful response.
+        if host not in self.limits:
+            return
+        throttled = status_code == 429 or status_code >= 500
+        conn = self.connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, blocked_until, backoff = self._bucket(conn, host, self.limits[host], now)
+            if throttled:
+                self.stats[host]["throttled"] += 1
+                backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, backoff * 2, retry_after or 0))
+                blocked_until = max(blocked_until, now + backoff)
+                print(f"Got {status_code} from {host}. Backing off for {backoff}s.")
+            elif not backoff:
+                return
+            else:
+                backoff = 0
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (host, tokens, updated, blocked_until, backoff) VALUES (?, ?, ?, ?, ?)",
+                (host, tokens, now, blocked_until, backoff),
+            )
+        finally:
+            conn.execute("COMMIT")
+
+    def get_stats(self):
+        conn = self.connection()
+        now = time.time()
+        stats = dict()
+        for host, budget in self.limits.items():
+            tokens, blocked_until, backoff = self._bucket(conn, host, budget, now)
+            stats[host] = dict(
+                self.stats[host],
+                tokens_available=round(tokens, 2),
+                tokens_in_use=round(budget.burst - tokens, 2),
+                blocked_for_seconds=round(max(0, blocked_until - now), 1),
+            )
+        return stats
+
+
+def background_bucket(host: str) -> str:
+    return f"{host} (background)"
+
+
+limiter = RateLimiter(
+    SUBDIR / "ratelimit.sqlite",
+    {**RATE_LIMITS, **{background_bucket(host): budget for host, budget in BACKGROUND_RATE_LIMITS.items()}},
+)
+# True while a background job makes requests, see in_background().
+background = ContextVar("background", default=False)
+
+
+@contextmanager
+def in_background():
+    # Requests made in this block (also from fanout pools started here) use the background budget.
+    token = background.set(True)
+    try:
+        yield
+    finally:
+        background.reset(token)
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    # Takes a token from the shared bucket of the host before every request.
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        if background.get():
+            limiter.acquire(background_bucket(host))
+        limiter.acquire(host)
+        response = super().send(request, **kwargs)
+        limiter.report(host, response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+        return response
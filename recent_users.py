@@ -0,0 +1,77 @@
+# Ring of the most recent visitors, shared by all workers, and the homepage snapshot that is computed from it
+# by a background job, so the homepage never waits for last.fm.
+import json
+import os
+import time
+from typing import List
+
+from file_cache import SUBDIR
+from sqlite_util import LocalConnection
+
+RING_SIZE = 100  # Keep this many recent users, enough to find SNAPSHOT_SIZE users with stats.
+SNAPSHOT_SIZE = 10
+SNAPSHOT_INTERVAL = 600  # seconds
+LEGACY_FILE = "recent.txt"
+
+connection = LocalConnection(SUBDIR / "recent_users.sqlite", schema=(
+    "CREATE TABLE IF NOT EXISTS recent_users ("
+    " username TEXT PRIMARY KEY,"
+    " seen REAL NOT NULL"
+    ")",
+    "CREATE INDEX IF NOT EXISTS recent_users_seen ON recent_users (seen)",
+    "CREATE TABLE IF NOT EXISTS snapshot ("
+    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+    " value TEXT NOT NULL,"
+    " updated REAL NOT NULL"
+    ")",
+))
+
+
+def add(username: str, seen: float = None):
+    conn = connection()
+    conn.execute("INSERT OR REPLACE INTO recent_users (username, seen) VALUES (?, ?)", (username, seen or time.time()))
+    # Drop everything older than the RING_SIZE most recent users.
+    conn.execute(
+        "DELETE FROM recent_users WHERE seen < (SELECT seen FROM recent_users ORDER BY seen DESC LIMIT 1 OFFSET ?)",
+        (RING_SIZE - 1,),
+    )
+
+
+def get_recent(limit: int = RING_SIZE) -> List[str]:
+    # Most recent user first
+    return [
+        row[0] for row in connection().execute(
+            "SELECT username FROM recent_users ORDER BY seen DESC LIMIT ?", (limit,)
+        )
+    ]
+
+
+def import_legacy_file():
+    # One-shot import of recent.txt, which had the most recent user at the end.
+    if not os.path.exists(LEGACY_FILE):
+        return
+    with open(LEGACY_FILE) as f:
+        usernames = [line.strip() for line in f if line.strip()]
+    now = time.time()
+    for i, username in enumerate(usernames[-RING_SIZE:]):
+        add(username, seen=now - RING_SIZE + i)
+    os.replace(LEGACY_FILE, LEGACY_FILE + ".imported")
+    print(f"Imported {len(usernames)} recent users from {LEGACY_FILE}")
+
+
+def save_snapshot(recent_stats: List):
+    connection().execute(
+        "INSERT OR REPLACE INTO snapshot (id, value, updated) VALUES (1, ?, ?)", (json.dumps(recent_stats), time.time())
+    )
+
+
+def get_snapshot() -> List:
+    # [(username, top album stat), ...] or an empty list before the first snapshot.
+    row = connection().execute("SELECT value FROM snapshot WHERE id = 1").fetchone()
+    return json.loads(row[0]) if row else []
+
+
+def get_snapshot_age() -> float:
+    # Seconds since the snapshot was saved, infinite before the first snapshot.
+    row = connection().execute("SELECT updated FROM snapshot WHERE id = 1").fetchone()
+    return time.time() - row[0] if row else float("inf")
@@ -4,7 +4,7 @@
 # Script to fetch album stats from last.fm and recalculate them based on track count per album.
 
 # Caching policy:
-# Track count and blast from the past: forever
+# Track count, weekly charts and the periods summed from them: forever
 # all time: 1 year
 # 365, 180: 1 month
 # 90, 30, 7:  1 day
@@ -12,16 +12,25 @@
 import base64
 import json
 import re
+import time
 import requests
+from collections import Counter, defaultdict
 from lxml import html
 from typing import Optional, Iterable, Dict, Tuple
-from random import randint
-from datetime import datetime
+from random import choice, sample, shuffle
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from urllib.parse import quote_plus
 
-from file_cache import file_cache_decorator, binary_file_cache_decorator
-from utils.api import _get_album_stats_api, _get_user_info
+import album_fallbacks
+import charts
+import period_index
+import scrobble_store
+from charts import get_album_stats_between
+from file_cache import file_cache_decorator, binary_file_cache_decorator, get_updated, update_cache
+from fanout import ordered_map
+from http_client import conditional_get, session
+from utils.api import _get_album_stats_api, _get_user_info, _get_album_info_api
 
 
 TIMEOUT = 8
@@ -42,94 +51,123 @@ print(s/len(d))
 # find cache/_get_album_details/ -type f -exec grep '13.48,' {} \; -delete
 # Also dont forget to change the corrections.txt file.
 
-session = requests.Session()
-a = requests.adapters.HTTPAdapter(max_retries=3)
-session.mount("https://", a)
-
 
 @binary_file_cache_decorator(return_path=True)
 def cache_binary_url_and_return_path(url: str) -> bytes:
     print("Getting " + url)
-    return session.get(url, timeout=TIMEOUT).content
+    return conditional_get(url, timeout=TIMEOUT).content
 
 
-@file_cache_decorator(keep_days=1)
+# Serve stale stats while refreshing in the background, so the first visitor after expiry does not wait for last.fm.
+@file_cache_decorator(keep_days=1, stale_while_revalidate=1, single_flight=True)
 def get_album_stats_cached_one_day(username, drange=None):
     return _get_album_stats(username, drange)
 
 
-@file_cache_decorator(keep_days=30)
+@file_cache_decorator(keep_days=30, stale_while_revalidate=7, single_flight=True)
 def get_album_stats_cached_one_month(username, drange=None):
     return _get_album_stats(username, drange)
 
 
-@file_cache_decorator(keep_days=365)
+@file_cache_decorator(keep_days=365, stale_while_revalidate=30, single_flight=True)
 def get_album_stats_cached_one_year(username, drange=None):
     return _get_album_stats(username, drange)
 
 
-@file_cache_decorator()
+@file_cache_decorator(single_flight=True)
 def get_album_stats_cached(username, drange=None):
     return _get_album_stats(username, drange)
 
 
-def get_album_stats(username: str, drange: Optional[str] = None) -> Iterable:
+def get_album_stats_tier(drange: Optional[str] = None):
+    # The cached function and its keep_days for a range.
     if drange and drange.startswith("http"):
         # blast from the past. cache forever
-        retval = get_album_stats_cached(username, drange)
+        return get_album_stats_cached, None
     elif drange and int(drange) < 180:
-        retval = get_album_stats_cached_one_day(username, drange)
+        return get_album_stats_cached_one_day, 1
     elif drange and int(drange) <= 365:
-        retval = get_album_stats_cached_one_month(username, drange)
+        return get_album_stats_cached_one_month, 30
     else:
-        retval = get_album_stats_cached_one_year(username, drange)
-    return json.loads(retval)
+        return get_album_stats_cached_one_year, 365
 
 
-def get_random_interval_from_library(username: str) -> str:
-    # select a random interval from the library
-    user_start_year = int(get_username_start_year(username))
-    today = datetime.today()
-    current_year = today.year
-    if user_start_year == current_year:
-        raise ValueError('User needs to be at least 1 year old for this feature to make sense.')
-
-    rand_year = randint(int(user_start_year), current_year - 1)
-    # To work with the last.fm api, start and end date for weeks need to be on monday 1300 in unix timestamp.
-    interval_type = randint(1, 5)
-    if interval_type == 1:
-        name = "random month"
-        rand_month = randint(1, 12)
-        start_date = datetime(year=rand_year, month=rand_month, day=1)
-        end_date = start_date + relativedelta(months=1)
-        date_str = start_date.strftime("%B %Y")
-    elif interval_type == 2:
-        name = "random week"
-        rand_week = randint(1, 53)
-        # Get date of monday of the requested weeknumber. (ISO 8601)
-        start_date = datetime.strptime(f"{rand_year} {rand_week} 1", "%G %V %w") + relativedelta(hours=13)
-        end_date = start_date + relativedelta(weeks=1)
-        date_str = start_date.strftime("%W %Y")
-    elif interval_type == 3:
-        name = "this month in history"
-        start_date = datetime(year=rand_year, month=today.month, day=1)
+def get_album_stats(username: str, drange: Optional[str] = None) -> Iterable:
+    if not (drange and drange.startswith("http")) and scrobble_store.is_ready(username):
+        start = datetime.now() - timedelta(days=int(drange)) if drange else None
+        return scrobble_store.get_album_stats(username, start, limit=MAX_ITEMS)
+    cached, _keep_days = get_album_stats_tier(drange)
+    return json.loads(cached(username, drange))
+
+
+def get_album_stats_version(username: str, drange: Optional[str] = None) -> Tuple[Optional[float], Optional[int]]:
+    # (update timestamp of the cached stats, keep_days of their tier). The timestamp is None when they are not
+    # cached yet, or when they are computed from the local scrobble store.
+    cached, keep_days = get_album_stats_tier(drange)
+    if scrobble_store.is_enabled():
+        return None, keep_days
+    return get_updated(username, drange, func_name=cached.__name__), keep_days
+
+
+INTERVAL_NAMES = ("random month", "random week", "this month in history", "this week in history", "random year")
+
+
+def get_interval(name: str, day: datetime) -> Tuple[str, str, datetime, datetime]:
+    # The period of this type that contains day: (name, date_str, start_date, end_date)
+    if name in ("random month", "this month in history"):
+        start_date = datetime(year=day.year, month=day.month, day=1)
         end_date = start_date + relativedelta(months=1)
         date_str = start_date.strftime("%B %Y")
-    elif interval_type == 4:
-        name = "this week in history"
-        # Get date of monday of the requested weeknumber. (ISO 8601)
-        start_date = datetime.strptime(f"{rand_year} {today.strftime('%W')} 1", "%G %V %w") + relativedelta(hours=13)
+    elif name in ("random week", "this week in history"):
+        # To work with the last.fm api, start and end date for weeks need to be on monday 1300 in unix timestamp.
+        start_date = datetime(year=day.year, month=day.month, day=day.day) - relativedelta(days=day.weekday(), hours=-13)
         end_date = start_date + relativedelta(weeks=1)
         date_str = start_date.strftime("%W %Y")
     else:
-        name = "random year"
-        start_date = datetime(year=rand_year, month=1, day=1)
+        start_date = datetime(year=day.year, month=1, day=1)
         end_date = start_date + relativedelta(years=1)
         date_str = start_date.strftime("%Y")
-    print(f"Trying {name}... {date_str}")
-    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklyalbumchart&user={username}&format=json&from={start_date.strftime('%s')}&to={end_date.strftime('%s')}"
+    return name, date_str, start_date, end_date
 
-    return name, date_str, url
+
+def get_random_interval(username: str) -> Optional[Tuple[str, str, datetime, datetime]]:
+    # A random period before this year that has scrobbles and whose weekly charts are all cached, so the stats
+    # need no call to last.fm. None when no such period is known yet.
+    index = period_index.get_week_index(username)
+    today = datetime.today()
+    days = [datetime.fromtimestamp((s + e) // 2) for (s, e), albums in index.items() if albums]
+    days = [day for day in days if day.year < today.year]
+    if not days:
+        return None
+    # Weeks before the user registered are empty, they are not indexed.
+    registered = get_username_registered(username)
+    chart_list = json.loads(charts.get_weekly_chart_list(username))
+    names = list(INTERVAL_NAMES)
+    shuffle(names)
+    for name in names:
+        candidates = {
+            get_interval(name, day)
+            for day in days
+            if (name != "this month in history" or day.month == today.month)
+            and (name != "this week in history" or day.isocalendar()[1] == today.isocalendar()[1])
+        }
+        for interval in sample(sorted(candidates), len(candidates)):
+            _name, _date_str, start_date, end_date = interval
+            weeks = charts.weeks_between(chart_list, int(start_date.timestamp()), int(end_date.timestamp()))
+            if all(week in index or week[1] <= registered for week in weeks):
+                return interval
+    return None
+
+
+def get_unindexed_random_week(username: str) -> Optional[Tuple[str, str, datetime, datetime]]:
+    # A random week before this year that is not in the index yet. Its stats need a single call to last.fm.
+    index = period_index.get_week_index(username)
+    this_year = datetime(year=datetime.today().year, month=1, day=1).timestamp()
+    weeks = [(s, e) for s, e in period_index.get_weeks_since_registered(username) if e <= this_year and (s, e) not in index]
+    if not weeks:
+        return None
+    s, e = choice(weeks)
+    return get_interval("random week", datetime.fromtimestamp((s + e) // 2))
 
 
 def _get_album_stats(
@@ -138,20 +176,99 @@ def _get_album_stats(
     return _get_album_stats_api(username, drange)
 
 
-@file_cache_decorator()
+# Bytes downloaded, time spent and calls per album details resolver. Per process.
+ALBUM_DETAILS_STATS = defaultdict(Counter)
+
+
+def _record_album_details_stats(path, start, num_bytes):
+    ALBUM_DETAILS_STATS[path]["calls"] += 1
+    ALBUM_DETAILS_STATS[path]["bytes"] += num_bytes
+    ALBUM_DETAILS_STATS[path]["seconds"] += time.perf_counter() - start
+
+
+def get_album_details_stats():
+    return {
+        path: dict(
+            counter,
+            avg_bytes=counter["bytes"] // counter["calls"],
+            avg_seconds=round(counter["seconds"] / counter["calls"], 3),
+        )
+        for path, counter in ALBUM_DETAILS_STATS.items()
+        if counter["calls"]
+    }
+
+
+def is_transient_error(e: requests.exceptions.RequestException) -> bool:
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def album_details_keep_days(value, artist_name, album_name=None):
+    # Fallbacks after a transient error are kept for a short time, real results forever.
+    if value.startswith(f"{AVERAGE_ALBUM_TRACK_COUNT},"):
+        return album_fallbacks.get_keep_days(artist_name, album_name or "")
+
+
+# A fallback that is past its TTL is still served until retry_album_details_fallbacks() replaces it, so requests
+# never wait for an album that failed before.
+@file_cache_decorator(
+    single_flight=True, memory_max_entries=50_000, keep_days_for=album_details_keep_days,
+    stale_while_revalidate=album_fallbacks.FALLBACK_MAX_TTL, refresh_stale=False,
+)
 def _get_album_details(artist_name, album_name) -> str:
     # What about albums that are detected incorrectly?
     # eg https://www.last.fm/music/Delain/April+Rain is recognized as the single, with only 2 tracks.
     # Maybe always add a cross check to discogs?
     # For now: ignore 1-2 track albums for now and just return the average.
+    # Try the small JSON api first, only scrape the album page when it does not know the track list.
+    start = time.perf_counter()
+    try:
+        track_count, cover_url, num_bytes = _get_album_info_api(artist_name, album_name)
+        _record_album_details_stats("api", start, num_bytes)
+    except (requests.exceptions.RequestException, ValueError):
+        # Also timeouts. The album page is tried next, a transient error there is recorded for a retry.
+        track_count = None
+    if track_count is None:
+        try:
+            result = _get_album_details_html(artist_name, album_name)
+        except requests.exceptions.RequestException as e:
+            if is_transient_error(e):
+                # Cached shortly and retried by retry_album_details_fallbacks()
+                album_fallbacks.record_failure(artist_name, album_name)
+            return f"{AVERAGE_ALBUM_TRACK_COUNT},"
+        album_fallbacks.record_success(artist_name, album_name)
+        return result
+    album_fallbacks.record_success(artist_name, album_name)
+    if track_count <= 2:
+        track_count = AVERAGE_ALBUM_TRACK_COUNT  # Probably not a real album
+    return f"{track_count},{cover_url}"
+
+
+def retry_album_details_fallbacks():
+    # Re-resolve albums that got a fallback track count because of a transient error.
+    for artist_name, album_name in album_fallbacks.get_due():
+        result = _get_album_details.__wrapped__(artist_name, album_name)
+        if album_fallbacks.get_keep_days(artist_name, album_name) is None:
+            print(f"Resolved fallback for {artist_name} - {album_name}: {result}")
+        # Also store a failed retry, so the fallback gets its new, longer TTL.
+        update_cache(artist_name, album_name, func_name="_get_album_details", result=result)
+
+
+def _get_album_details_html(artist_name, album_name) -> str:
+    # Raises on transient errors, other HTTP errors (eg. 404) result in the average track count.
     artist_name = artist_name.replace('+', '%2B')  # Fix for Cuby+Blizzards. + Needs to be encoded twice.
     url = "https://www.last.fm/music/" + quote_plus(artist_name) + "/" + quote_plus(album_name)
     print("Getting " + url)
+    start = time.perf_counter()
+    response = session.get(url, timeout=TIMEOUT)
     try:
-        response = session.get(url, timeout=TIMEOUT)
         response.raise_for_status()
-    except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+    except requests.exceptions.HTTPError as e:
+        if is_transient_error(e):
+            raise
         return f"{AVERAGE_ALBUM_TRACK_COUNT},"
+    _record_album_details_stats("html", start, len(response.content))
 
     page = response.text
     doc = html.fromstring(page)
@@ -201,7 +318,8 @@ def correct_overview_stats(stats: Dict) -> Dict[int, Iterable[Dict]]:
     return {per: correct_album_stats(stats) for per, stats in stats.items()}
 
 
-@file_cache_decorator()
+# Consulted by username_exists on every request, so keep it in memory.
+@file_cache_decorator(memory_max_entries=10_000)
 def get_user_info(username):
     return _get_user_info(username)
 
@@ -219,21 +337,30 @@ def username_exists(username):
         return True
 
 
+def get_username_registered(username: str) -> int:
+    '''Get the unix timestamp at which the user created the account.'''
+    user_info = json.loads(get_user_info(username))
+    return int(user_info['user']['registered']['unixtime'])
+
+
 def get_username_start_year(username: str) -> int:
     '''Get username start year (user created account in this year).'''
     print(f"Get username start year: {username}", end=': ')
-    user_info = json.loads(get_user_info(username))
-    user_registered = datetime.fromtimestamp(int(user_info['user']['registered']['unixtime']))
-    return user_registered.year
+    return datetime.fromtimestamp(get_username_registered(username)).year
 
 
-@file_cache_decorator()
-def get_image_base64(url: str) -> str:
+def iter_image_base64(url: str, chunk_size: int = 3 * 16 * 1024) -> Iterable[str]:
+    # The image from the binary cache (shared with the covers), encoded in chunks for inline embedding.
+    # chunk_size is a multiple of 3, so the encoded chunks can be concatenated.
     if not url:
-        return ""
-    print(url)
-    data = session.get(url, timeout=TIMEOUT).content
-    return base64.b64encode(data).decode("utf-8")
+        return
+    with open(cache_binary_url_and_return_path(url), "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield base64.b64encode(chunk).decode("ascii")
+
+
+def get_image_base64(url: str) -> str:
+    return "".join(iter_image_base64(url))
 
 
 def get_album_stats_year_month(username, year, month=None):
@@ -245,8 +372,7 @@ def get_album_stats_year_month(username, year, month=None):
         end_date = start_date + relativedelta(years=1)
     if end_date.date() >= today.date():
         return  # Only consider stats from the past
-    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklyalbumchart&user={username}&format=json&from={start_date.strftime('%s')}&to={end_date.strftime('%s')}"
-    return get_album_stats(username, url)
+    return get_album_stats_between(username, start_date, end_date)
 
 
 def get_album_stats_year_week(username, year, week):
@@ -257,19 +383,27 @@ def get_album_stats_year_week(username, year, week):
     end_date = start_date + relativedelta(weeks=1)
     if end_date.date() >= today.date():
         return  # Only consider stats from the past
-    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklyalbumchart&user={username}&format=json&from={start_date.strftime('%s')}&to={end_date.strftime('%s')}"
-    return get_album_stats(username, url)
+    return get_album_stats_between(username, start_date, end_date)
+
+
+def _get_overview(get_stats, periods) -> Dict[int, Iterable]:
+    # Fetch the stats of the periods in parallel on the overview pool, in the order of periods.
+    # Not used on the request path (the overview page fetches its tiles itself), so wait for every period.
+    def get_period_stats(period):
+        return period, get_stats(period) or []
+
+    results = ordered_map(get_period_stats, periods, pool="overview", deadline=None)
+    overview = dict(results)
+    if not results.complete:
+        print(f"Failed to get the stats of periods {[period for period in periods if period not in overview]}")
+    return overview
 
 
 def get_overview_per_year(username: str) -> Dict[int, Iterable]:
-    overview = dict()
     start_year = int(get_username_start_year(username))
     today = datetime.today()
     current_year = today.year
-    for year in range(start_year, current_year):
-        stats = get_album_stats_year_month(username, year)
-        overview[year] = stats if len(stats) else []
-    return overview
+    return _get_overview(lambda year: get_album_stats_year_month(username, year), range(start_year, current_year))
 
 
 def get_overview_per_month(username: str, year: int) -> Dict[int, Iterable]:
@@ -277,11 +411,7 @@ def get_overview_per_month(username: str, year: int) -> Dict[int, Iterable]:
     assert year <= today.year, "Year should not be in the future"
     start_year = int(get_username_start_year(username))
     assert year >= start_year, f"Account was created in {start_year}"
-    overview = dict()
-    for month in range(1, 12 + 1):
-        stats = get_album_stats_year_month(username, year, month) or []
-        overview[month] = stats if len(stats) else []
-    return overview
+    return _get_overview(lambda month: get_album_stats_year_month(username, year, month), range(1, 12 + 1))
 
 
 def get_overview_per_week(username: str, year: int) -> Dict[int, Iterable]:
@@ -289,28 +419,21 @@ def get_overview_per_week(username: str, year: int) -> Dict[int, Iterable]:
     assert year <= today.year, "Year should not be in the future"
     start_year = int(get_username_start_year(username))
     assert year >= start_year, f"Account was created in {start_year}"
-    overview = dict()
-    for week in range(1, 53 + 1):
-        stats = get_album_stats_year_week(username, year, week) or []
-        overview[week] = stats if len(stats) else []
-    return overview
+    return _get_overview(lambda week: get_album_stats_year_week(username, year, week), range(1, 53 + 1))
 
 
 def get_album_stats_inc_random(username, drange, overview_per=None):
     if drange == "random":
-        url = None
-        stats = []
-        tries = 0
-        while not len(stats) and tries < 10:
-            try:
-                blast_name, period, url = get_random_interval_from_library(username)
-            except ValueError:
-                return stats, None, None
-            # need to test if the user has listening data in the selected interval
-            # special case, use url as 'drange'
-            stats = get_album_stats(username, url)
-            tries += 1
-        return stats, blast_name, period
+        interval = get_random_interval(username)
+        if interval is None:
+            # Nothing known about this user yet. Index the weekly charts for the next time, try a single week now.
+            period_index.index_in_background(username)
+            interval = get_unindexed_random_week(username)
+            if interval is None:
+                return [], None, None  # No weeks before this year
+        blast_name, period, start_date, end_date = interval
+        print(f"Trying {blast_name}... {period}")
+        return get_album_stats_between(username, start_date, end_date), blast_name, period
     elif drange == "overview":
         if overview_per:
             if overview_per.endswith('week'):
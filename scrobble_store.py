@@ -0,0 +1,133 @@
+# Opt-in local copy of the scrobbles of active users. Enable it with SCROBBLE_STORE=1.
+# The first sync downloads the complete history in the background, after that only new scrobbles are fetched.
+# All ranges and periods are then computed locally with aggregate queries.
+import threading
+import time
+from datetime import datetime
+from os import getenv
+from typing import List, Optional
+
+from file_cache import SUBDIR, key_lock
+from ratelimit import in_background
+from sqlite_util import LocalConnection
+from utils.api import _get_recent_tracks_api
+
+SYNC_INTERVAL = 300  # seconds. Fetch new scrobbles at most this often per user.
+
+connection = LocalConnection(SUBDIR / "scrobbles.sqlite", schema=(
+    "CREATE TABLE IF NOT EXISTS scrobbles ("
+    " user TEXT NOT NULL,"
+    " ts INTEGER NOT NULL,"
+    " artist TEXT NOT NULL,"
+    " album TEXT NOT NULL,"
+    " track TEXT NOT NULL"
+    ")",
+    "CREATE UNIQUE INDEX IF NOT EXISTS scrobbles_user_ts ON scrobbles (user, ts, artist, track)",
+    "CREATE INDEX IF NOT EXISTS scrobbles_user_album ON scrobbles (user, album, artist)",
+    "CREATE TABLE IF NOT EXISTS sync_state ("
+    " user TEXT PRIMARY KEY,"
+    " complete INTEGER NOT NULL DEFAULT 0,"  # 1 when the complete history has been downloaded
+    " synced REAL NOT NULL DEFAULT 0"
+    ")",
+))
+
+
+def is_enabled() -> bool:
+    return bool(int(getenv("SCROBBLE_STORE") or 0))
+
+
+def insert(username: str, scrobbles):
+    connection().executemany(
+        "INSERT OR IGNORE INTO scrobbles (user, ts, artist, album, track) VALUES (?, ?, ?, ?, ?)",
+        ((username, *scrobble) for scrobble in scrobbles),
+    )
+
+
+def _fetch(username: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None):
+    # Pages are ordered from new to old. Each page is stored in its own transaction.
+    page, total_pages = 1, 1
+    conn = connection()
+    while page <= total_pages:
+        scrobbles, total_pages = _get_recent_tracks_api(username, page, from_ts=from_ts, to_ts=to_ts)
+        conn.execute("BEGIN")
+        insert(username, scrobbles)
+        conn.execute("COMMIT")
+        page += 1
+
+
+def _fetch_new(username: str, from_ts: int):
+    # Stores the oldest page first, so the newest stored scrobble only moves past scrobbles that are all stored and
+    # an interrupted fetch is resumed by the next sync. The pages do not shift while new scrobbles come in,
+    # because to_ts is fixed.
+    to_ts = int(time.time())
+    first_page, total_pages = _get_recent_tracks_api(username, 1, from_ts=from_ts, to_ts=to_ts)
+    conn = connection()
+    for page in range(total_pages, 0, -1):
+        if page == 1:
+            scrobbles = first_page
+        else:
+            scrobbles, _total_pages = _get_recent_tracks_api(username, page, from_ts=from_ts, to_ts=to_ts)
+        conn.execute("BEGIN")
+        insert(username, scrobbles)
+        conn.execute("COMMIT")
+
+
+def sync(username: str):
+    # Download the missing history (resuming an interrupted first sync) or only the new scrobbles.
+    conn = connection()
+    state = conn.execute("SELECT complete FROM sync_state WHERE user = ?", (username,)).fetchone()
+    oldest, newest = conn.execute("SELECT min(ts), max(ts) FROM scrobbles WHERE user = ?", (username,)).fetchone()
+    if newest:
+        _fetch_new(username, from_ts=newest + 1)
+    if not state or not state[0]:
+        _fetch(username, to_ts=oldest - 1 if oldest else None)
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (user, complete, synced) VALUES (?, 1, ?)", (username, time.time())
+    )
+
+
+def sync_in_background(username: str):
+    def run():
+        # Only one worker syncs a user at a time, on the background budget of the rate limiter.
+        with key_lock("scrobble_store", username, timeout=0) as acquired, in_background():
+            if acquired:
+                try:
+                    sync(username)
+                except Exception as e:
+                    print(f"Scrobble sync failed for {username}: {e!r}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def is_ready(username: str) -> bool:
+    # True when the store can be used for this user. Starts the first sync or fetches new scrobbles when needed.
+    if not is_enabled():
+        return False
+    state = connection().execute("SELECT complete, synced FROM sync_state WHERE user = ?", (username,)).fetchone()
+    if not state or not state[0]:
+        sync_in_background(username)
+        return False
+    if time.time() - state[1] > SYNC_INTERVAL:
+        with key_lock("scrobble_store", username) as acquired:
+            if acquired:
+                try:
+                    sync(username)  # One small delta fetch
+                except Exception as e:
+                    print(f"Scrobble sync failed for {username}, using stored scrobbles: {e!r}")
+    return True
+
+
+def get_album_stats(username: str, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 20) -> List:
+    # Same format as the charts of the api: (album, artist, playcount, rank)
+    start_ts = int(start.timestamp()) if start else 0
+    end_ts = int(end.timestamp()) if end else 2 ** 62
+    rows = connection().execute(
+        "SELECT album, artist, count(*) AS playcount FROM scrobbles"
+        " WHERE user = ? AND ts >= ? AND ts < ? AND album != ''"
+        " GROUP BY album, artist ORDER BY playcount DESC, max(ts) DESC LIMIT ?",
+        (username, start_ts, end_ts, limit),
+    ).fetchall()
+    return [
+        [album_name, artist_name, str(playcount), str(rank)]
+        for rank, (album_name, artist_name, playcount) in enumerate(rows, start=1)
+    ]
@@ -0,0 +1,30 @@
+# Helper for the small SQLite databases in the cache dir.
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class LocalConnection:
+    # One connection per thread and per process (gunicorn forks workers). The schema is created on connect,
+    # migrate(conn) can then upgrade databases that were created with an older schema.
+    def __init__(self, filename, schema=(), migrate=None):
+        self.filename = Path(filename)
+        self.schema = schema
+        self.migrate = migrate
+        self._local = threading.local()
+
+    def __call__(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                conn.execute(statement)
+            if self.migrate:
+                self.migrate(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -1,6 +1,5 @@
 import smtplib
 import datetime
-from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 from email.message import EmailMessage
 from itsdangerous import URLSafeTimedSerializer
@@ -8,11 +7,13 @@ from itsdangerous.exc import BadSignature
 
 from typing import Dict
 
+from file_cache import Uncacheable, fragment_cache_decorator
 from util import get_period_stats
 from config import SECRET_KEY, FROM_ADDRESS
 
 CONFIRMATION_SALT = 'confirmation'
 EMAIL_TYPES = ('weekly', 'monthly', 'yearly')
+NO_MUSIC = 'You didnt listen to any music last'
 
 
 def generate_confirmation_token(email):
@@ -109,13 +110,14 @@ def get_permalink(username, period_dict, debug):
     return base_url + f'/get_stat?username={ username }&year={ year }'
 
 
-def get_stat_for(username, email_type, period, debug):
+def get_stat_for(username, email_type, period, debug, stats=None):
     assert email_type in EMAIL_TYPES
     period_name = email_type.rstrip('ly')
-    stats = get_period_stats(username, period.get('year'), period.get('month'), period.get('week'))
+    if stats is None:
+        stats = get_period_stats(username, period.get('year'), period.get('month'), period.get('week'))
     top_album_str = nothing = None
     if not stats:
-        nothing = f'You didnt listen to any music last { period_name }!'
+        nothing = f'{ NO_MUSIC } { period_name }!'
     else:
         top_album = stats[0]
         top_album_str = f"""
@@ -151,11 +153,21 @@ Denick from albumscrobbles.com
     return subject, body
 
 
-@lru_cache()
+def rss_stat_keep_days(stat):
+    # A period that just ended can have no charts yet, so check again tomorrow.
+    _subject, _permalink, body = stat
+    return 1 if NO_MUSIC in body else None
+
+
+@fragment_cache_decorator(keep_days=7, keep_days_for=rss_stat_keep_days)
 def get_stat_for_rss(username, email_type, year, month=None, week=None, debug=False):
     period = dict(year=year, month=month, week=week)
-    subject, permalink, lastfm_link, body = get_stat_for(username, email_type, period, debug)
+    stats = get_period_stats(username, year, month, week)
+    subject, permalink, lastfm_link, body = get_stat_for(username, email_type, period, debug, stats=stats)
     body = body.replace('\n', '<br>').replace(permalink, f'<a href="{permalink}">{permalink}</a>').replace(lastfm_link, f'<a href="{lastfm_link}">{lastfm_link}</a>')
+    if not stats.complete:
+        # Albums are missing after the deadline, so the top album may be wrong. Try again on the next request.
+        raise Uncacheable((subject, permalink, body))
     return subject, permalink, body
 
 
@@ -164,7 +176,11 @@ def send_periodic_emails(subscriber_lines, email_type, debug):
     with smtplib.SMTP('localhost') as conn:
         for subscriber_line in subscriber_lines:
             username, email = subscriber_line
-            subject, body = get_stat_for_email(username, email_type, debug)
+            try:
+                subject, body = get_stat_for_email(username, email_type, debug)
+            except Exception as e:
+                print(f"Skipping {email_type} e-mail to {username}: {e!r}")
+                continue
             if debug:
                 print('-' * 80)
                 print(body)
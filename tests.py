@@ -1,8 +1,36 @@
 import unittest
+import base64
+import io
 import re
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import patch
 
 from freezegun import freeze_time
 
+import requests
+
+import album_fallbacks
+import charts
+import file_cache
+import http_client
+import period_index
+import ratelimit
+import scrape
+import recent_users
+import scrobble_store
+import util
+from cache_backends import FileBackend, SqliteBackend, migrate
+from cache_janitor import Budget, run_janitor
+from circuitbreaker import CircuitBreaker, CircuitOpenError
+from fanout import Results, completed_map, ordered_map
+from ratelimit import Budget as RateBudget, RateLimiter, RateLimitTimeout
+from sqlite_util import LocalConnection
 from scrape import username_regex
 from subscribe_util import get_most_recent_period
 
@@ -55,5 +83,805 @@ class TestMostRecentWeeknumber(unittest.TestCase):
         assert week == 2, week
 
 
+def patch_connection(test, module, name="connection"):
+    # Use a new copy of a SQLite database (a sqlite_util.LocalConnection) in the temporary directory of the test.
+    original = getattr(module, name)
+    connection = patch.object(module, name, LocalConnection(Path(test.tmp.name) / original.filename.name, original.schema))
+    connection.start()
+    test.addCleanup(connection.stop)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    # Modules whose connection is replaced by one to an empty database in a temporary directory.
+    databases = ()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for module in self.databases:
+            patch_connection(self, module)
+
+
+def hammer_single_flight_key(cache_dir, calls_file, barrier):
+    @file_cache.file_cache_decorator(backend=FileBackend(cache_dir), single_flight=True)
+    def upstream(key):
+        with open(calls_file, "a") as f:
+            f.write(key + "\n")
+        time.sleep(0.5)
+        return "result"
+
+    barrier.wait()
+    assert upstream("popular-user") == "result"
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.backends = [
+            FileBackend(Path(self.tmp.name) / "files"),
+            SqliteBackend(Path(self.tmp.name) / "cache.sqlite"),
+        ]
+
+    def test_decorator_caches_result(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                calls = []
+
+                @file_cache.file_cache_decorator(backend=backend)
+                def cached(a, b):
+                    calls.append((a, b))
+                    return f"{a},{b}"
+
+                self.assertEqual(cached("x", "y/z"), "x,y/z")
+                self.assertEqual(cached("x", "y/z"), "x,y/z")
+                self.assertEqual(calls, [("x", "y/z")])
+
+    def test_sqlite_backend_adds_accessed_column(self):
+        import sqlite3
+        filename = Path(self.tmp.name) / "old.sqlite"
+        with sqlite3.connect(filename) as conn:
+            conn.execute(
+                "CREATE TABLE cache (func_name TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+                " updated REAL NOT NULL, expires REAL, PRIMARY KEY (func_name, key)) WITHOUT ROWID"
+            )
+            conn.execute("INSERT INTO cache VALUES ('func', 'x', 'old', 0, NULL)")
+        self.assertEqual(SqliteBackend(filename).get("func", "x").value, "old")
+        with self.assertRaises(ValueError):
+            file_cache.get_backend("unknown")
+
+    def test_empty_arguments_are_part_of_the_key(self):
+        keys = [("a", "", "b"), ("a", "b"), ("a", None, "b"), ("a", "b", ""), ("a", "b", None)]
+        self.assertEqual(len({file_cache.make_key(*args) for args in keys}), len(keys))
+
+    def test_expired_entry_is_refetched(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                calls = []
+
+                @file_cache.file_cache_decorator(keep_days=1, backend=backend)
+                def cached(a):
+                    calls.append(a)
+                    return "new"
+
+                two_days_ago = (datetime.now() - timedelta(days=2)).timestamp()
+                backend.set("cached", "x", "old", updated=two_days_ago)
+                self.assertEqual(cached("x"), "new")
+                self.assertEqual(calls, ["x"])
+
+    def test_stale_while_revalidate(self):
+        backend = self.backends[0]
+        refreshed = threading.Event()
+
+        @file_cache.file_cache_decorator(keep_days=1, stale_while_revalidate=1, backend=backend)
+        def cached(a):
+            refreshed.set()
+            return "new"
+
+        a_day_and_a_half_ago = (datetime.now() - timedelta(days=1.5)).timestamp()
+        backend.set("cached", "x", "old", updated=a_day_and_a_half_ago)
+        self.assertEqual(cached("x"), "old")
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(50):
+            if backend.get("cached", "x").value == "new":
+                break
+            time.sleep(0.1)
+        self.assertEqual(cached("x"), "new")
+
+        three_days_ago = (datetime.now() - timedelta(days=3)).timestamp()
+        backend.set("cached", "x", "old", updated=three_days_ago)
+        self.assertEqual(cached("x"), "new")  # Past the hard limit the caller waits for a fresh value
+
+    def test_stale_value_is_only_served_without_refresh_stale(self):
+        backend = self.backends[0]
+        calls = []
+
+        @file_cache.file_cache_decorator(
+            backend=backend, keep_days_for=lambda value, a: 1 if value == "fallback" else None,
+            stale_while_revalidate=7, refresh_stale=False, memory_max_entries=10,
+        )
+        def cached(a):
+            calls.append(a)
+            return "new"
+
+        two_days_ago = (datetime.now() - timedelta(days=2)).timestamp()
+        backend.set("cached", "x", "fallback", updated=two_days_ago)
+        self.assertEqual(cached("x"), "fallback")
+        self.assertNotIn(("cached", "x"), file_cache._refreshing)
+        self.assertEqual(calls, [])
+        backend.set("cached", "x", "real")  # By the background job
+        self.assertEqual(cached("x"), "real")
+
+    def test_background_refresh_skipped_while_key_is_locked(self):
+        backend = self.backends[0]
+        self.addCleanup(setattr, file_cache, "LOCK_DIR", file_cache.LOCK_DIR)
+        file_cache.LOCK_DIR = Path(self.tmp.name) / ".locks"
+        calls = []
+
+        @file_cache.file_cache_decorator(keep_days=1, stale_while_revalidate=1, backend=backend)
+        def cached(a):
+            calls.append(a)
+            return "new"
+
+        a_day_and_a_half_ago = (datetime.now() - timedelta(days=1.5)).timestamp()
+        backend.set("cached", "x", "old", updated=a_day_and_a_half_ago)
+        # Another process is computing the same key
+        with file_cache.key_lock("cached", "x") as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(cached("x"), "old")
+            for _ in range(50):
+                if ("cached", "x") not in file_cache._refreshing:
+                    break
+                time.sleep(0.1)
+        self.assertEqual(calls, [])
+        self.assertEqual(backend.get("cached", "x").value, "old")
+
+    def test_single_flight_across_processes(self):
+        ctx = multiprocessing.get_context("fork")
+        self.addCleanup(setattr, file_cache, "LOCK_DIR", file_cache.LOCK_DIR)
+        file_cache.LOCK_DIR = Path(self.tmp.name) / ".locks"
+        calls_file = Path(self.tmp.name) / "calls.txt"
+        barrier = ctx.Barrier(4)
+        processes = [
+            ctx.Process(target=hammer_single_flight_key, args=(Path(self.tmp.name) / "files", calls_file, barrier))
+            for _ in range(4)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual([p.exitcode for p in processes], [0] * 4)
+        self.assertEqual(calls_file.read_text().splitlines(), ["popular-user"])
+
+    def test_janitor_purges_expired_and_evicts_lru(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                self.addCleanup(file_cache.NAMESPACES.pop, "func", None)
+                file_cache.NAMESPACES["func"] = 1
+                now = time.time()
+                backend.set("func", "expired", "x" * 10, updated=now - 3 * 24 * 3600)
+                for key in ("old", "recent", "newest"):
+                    backend.set("func", key, "x" * 10, updated=now - 2 * 3600)
+                    backend.get("func", key)  # Records the access time
+                    time.sleep(0.01)
+                [report] = run_janitor([backend], {"func": Budget(max_bytes=1000, max_entries=2)})
+                self.assertEqual((report.expired, report.evicted, report.reclaimed_bytes), (1, 1, 20))
+                self.assertEqual(sorted(e.key for e in backend.scan("func")), ["newest", "recent"])
+
+    def test_expired_entry_is_revalidated(self):
+        patch_connection(self, file_cache, "validators_connection")
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                sent = []
+
+                @file_cache.file_cache_decorator(keep_days=1, backend=backend)
+                def cached(a):
+                    validators = file_cache.revalidating.get()
+                    sent.append(dict(validators))
+                    if validators.get("etag") == '"v1"':
+                        raise file_cache.NotModified()
+                    validators["etag"] = '"v1"'
+                    return "body"
+
+                self.assertEqual(cached("x"), "body")
+                two_days_ago = (datetime.now() - timedelta(days=2)).timestamp()
+                backend.set("cached", "x", "body", updated=two_days_ago)
+                self.assertEqual(cached("x"), "body")
+                self.assertEqual(sent, [{}, dict(etag='"v1"', last_modified=None)])
+                self.assertGreater(backend.get("cached", "x").updated, two_days_ago)  # Renewed
+                self.assertEqual(cached("x"), "body")
+                self.assertEqual(len(sent), 2)
+
+    def test_fragment_cache_binds_arguments(self):
+        calls = []
+
+        @file_cache.fragment_cache_decorator(keep_days=1, backend=self.backends[0])
+        def render(username, year, month=None):
+            calls.append((username, year, month))
+            return f"<b>{username} {year} {month}</b>", year
+
+        self.assertEqual(render("user", 2020), ["<b>user 2020 None</b>", 2020])
+        self.assertEqual(render("user", year=2020, month=None), ["<b>user 2020 None</b>", 2020])
+        render("user", 2020, 5)
+        self.assertEqual(calls, [("user", 2020, None), ("user", 2020, 5)])
+        self.assertEqual(file_cache.CACHE_STATS["fragment_render"]["memory_hit"], 1)
+
+    def test_cached_path_is_returned_without_reading_the_file(self):
+        backend = self.backends[0]
+
+        @file_cache.binary_file_cache_decorator(return_path=True, backend=backend)
+        def download(url):
+            return b"image"
+
+        path = download("https://img/a.png")
+        self.assertEqual(path.read_bytes(), b"image")
+        with patch.object(backend, "get", side_effect=AssertionError("read")):
+            self.assertEqual(download("https://img/a.png"), path)
+
+    def test_uncacheable_result_is_returned_but_not_cached(self):
+        calls = []
+
+        @file_cache.fragment_cache_decorator(keep_days=1, backend=self.backends[0])
+        def render(username):
+            calls.append(username)
+            if len(calls) == 1:
+                raise file_cache.Uncacheable("<b>partial</b>")
+            return "<b>complete</b>"
+
+        self.assertEqual(render("user"), "<b>partial</b>")
+        self.assertEqual(render("user"), "<b>complete</b>")
+        self.assertEqual(render("user"), "<b>complete</b>")
+        self.assertEqual(calls, ["user", "user"])
+
+    def test_rss_stat_is_cached_only_when_complete(self):
+        import subscribe_util
+        backend = self.backends[0]
+        album = {"album_name": "Album", "artist_name": "Artist", "album_scrobble_count": 3}
+        with patch("file_cache.backend", backend), patch("subscribe_util.get_period_stats") as get_period_stats:
+            partial = Results([album])
+            partial.complete = False
+            get_period_stats.return_value = partial
+            self.assertIn("Album by Artist", subscribe_util.get_stat_for_rss("user", "weekly", 2020, week=3)[2])
+            get_period_stats.return_value = Results([album])
+            subscribe_util.get_stat_for_rss("user", "weekly", 2020, week=3)
+            subscribe_util.get_stat_for_rss("user", "weekly", 2020, week=3)
+            self.assertEqual(get_period_stats.call_count, 2)
+
+            complete = subscribe_util.get_stat_for_rss("user", "weekly", 2020, week=3)
+            get_period_stats.return_value = Results()
+            empty = subscribe_util.get_stat_for_rss("user", "weekly", 2020, week=4)
+        self.assertIsNone(subscribe_util.rss_stat_keep_days(complete))
+        self.assertEqual(subscribe_util.rss_stat_keep_days(empty), 1)
+
+    def test_migrate_base64_images_to_binary_cache(self):
+        from click.testing import CliRunner
+        from cache_cli import cli
+        backend = self.backends[0]
+        url = "https://lastfm.freetls.fastly.net/i/u/300x300/abcd.png"
+        backend.set("get_image_base64", url, base64.b64encode(b"\x89PNG image").decode("utf-8"))
+        with patch("file_cache.backend", backend):
+            result = CliRunner().invoke(cli, ["migrate-base64"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(backend.get("cache_binary_url_and_return_path", url, binary=True).value, b"\x89PNG image")
+            self.assertEqual(list(backend.scan("get_image_base64")), [])
+            with patch("scrape.cache_binary_url_and_return_path", return_value=backend.path("cache_binary_url_and_return_path", url)):
+                self.assertEqual(scrape.get_image_base64(url), base64.b64encode(b"\x89PNG image").decode("utf-8"))
+
+    def test_long_keys_do_not_collide(self):
+        backend = self.backends[0]
+        artist = "a" * 200
+
+        @file_cache.file_cache_decorator(backend=backend)
+        def cached(artist, album):
+            return album
+
+        self.assertEqual(cached(artist, "first"), "first")
+        self.assertEqual(cached(artist, "second"), "second")
+        self.assertEqual(sorted(backend.read_key_log("cached").values()), [f"{artist}\x1ffirst", f"{artist}\x1fsecond"])
+
+    def test_legacy_layout_is_migrated_on_read(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                if isinstance(backend, FileBackend):
+                    legacy = backend.legacy_path("cached", "Artist-AC-DC")
+                    legacy.parent.mkdir(parents=True)
+                    legacy.write_text("10,")
+                else:
+                    backend.set("cached", "Artist-AC-DC", "10,")
+
+                @file_cache.file_cache_decorator(backend=backend)
+                def cached(artist, album):
+                    raise AssertionError("Should be read from the legacy entry")
+
+                self.assertEqual(cached("Artist", "AC/DC"), "10,")
+                self.assertEqual([e.key for e in backend.scan("cached")], ["Artist\x1fAC/DC"])
+
+    def test_memory_tier(self):
+        backend = self.backends[0]
+        self.addCleanup(setattr, file_cache, "GENERATION_DIR", file_cache.GENERATION_DIR)
+        file_cache.GENERATION_DIR = Path(self.tmp.name) / ".generations"
+
+        @file_cache.file_cache_decorator(backend=backend, memory_max_entries=2)
+        def memory_cached(a):
+            return a
+
+        for key in ("a", "b", "a", "c", "b"):
+            memory_cached(key)
+        # b was evicted as least recently used when c was added, and a when b was read back
+        stats = file_cache.CACHE_STATS["memory_cached"]
+        self.assertEqual((stats["memory_hit"], stats["memory_miss"]), (1, 4))
+        self.assertEqual((stats["disk_hit"], stats["disk_miss"]), (1, 3))
+
+        backend.set("memory_cached", "b", "corrected")
+        self.assertEqual(memory_cached("b"), "b")
+        file_cache.invalidate("memory_cached")
+        self.assertEqual(memory_cached("b"), "corrected")
+
+    def test_expired_entry_is_served_when_upstream_fails(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+
+                @file_cache.file_cache_decorator(keep_days=1, backend=backend)
+                def cached(a):
+                    raise CircuitOpenError("last.fm is down")
+
+                backend.set("cached", "x", "old", updated=(datetime.now() - timedelta(days=10)).timestamp())
+                token = file_cache.served_stale.set([])
+                self.addCleanup(file_cache.served_stale.reset, token)
+                self.assertEqual(cached("x"), "old")
+                self.assertEqual(file_cache.served_stale.get(), ["cached"])
+                with self.assertRaises(CircuitOpenError):
+                    cached("not cached")
+
+    def test_migrate_file_tree_to_sqlite(self):
+        source, target = self.backends
+        source.set("func", "key", "text")
+        source.set("binary_func", "key", b"\x89PNG\xff")
+        self.assertEqual(migrate(source, target), 2)
+        self.assertEqual(target.get("func", "key").value, "text")
+        self.assertEqual(target.get("binary_func", "key", binary=True).value, b"\x89PNG\xff")
+
+
+class TestAlbumDetails(unittest.TestCase):
+    def setUp(self):
+        fallbacks = patch("scrape.album_fallbacks")
+        self.fallbacks = fallbacks.start()
+        self.addCleanup(fallbacks.stop)
+
+    def test_api_result_is_used(self):
+        with patch("scrape._get_album_info_api", return_value=(11, "https://img/cover.png", 1000)), \
+                patch("scrape._get_album_details_html") as html:
+            self.assertEqual(scrape._get_album_details.__wrapped__("Artist", "Album"), "11,https://img/cover.png")
+            html.assert_not_called()
+
+    def test_single_is_counted_as_average(self):
+        with patch("scrape._get_album_info_api", return_value=(2, "", 1000)):
+            self.assertEqual(scrape._get_album_details.__wrapped__("Artist", "Single"), "13.48,")
+
+    def test_falls_back_to_html_without_track_list(self):
+        with patch("scrape._get_album_info_api", return_value=(None, "", 100)), \
+                patch("scrape._get_album_details_html", return_value="9,https://img/x.png") as html:
+            self.assertEqual(scrape._get_album_details.__wrapped__("Artist", "Album"), "9,https://img/x.png")
+            html.assert_called_once_with("Artist", "Album")
+
+    def test_transient_error_is_recorded_as_fallback(self):
+        with patch("scrape._get_album_info_api", side_effect=requests.exceptions.ConnectionError), \
+                patch("scrape._get_album_details_html", side_effect=requests.exceptions.ConnectionError):
+            self.assertEqual(scrape._get_album_details.__wrapped__("Artist", "Album"), "13.48,")
+            self.fallbacks.record_failure.assert_called_once_with("Artist", "Album")
+
+    def test_api_timeout_falls_back_to_html(self):
+        with patch("scrape._get_album_info_api", side_effect=requests.exceptions.ReadTimeout), \
+                patch("scrape._get_album_details_html", return_value="9,https://img/x.png"):
+            self.assertEqual(scrape._get_album_details.__wrapped__("Artist", "Album"), "9,https://img/x.png")
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.limits = {"api": RateBudget(rate=20, burst=2)}
+
+    def test_bucket_is_shared(self):
+        # Two instances stand in for two worker processes using the same database.
+        limiters = [RateLimiter(Path(self.tmp.name) / "ratelimit.sqlite", self.limits) for _ in range(2)]
+        start = time.monotonic()
+        for i in range(6):
+            limiters[i % 2].acquire("api")
+        # 2 tokens from the burst, 4 refilled at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        limiters[0].acquire("other host")  # Not limited
+
+    def test_backoff_after_throttling(self):
+        limiter = RateLimiter(Path(self.tmp.name) / "ratelimit.sqlite", self.limits)
+        limiter.report("api", 429, retry_after=0.3)
+        stats = limiter.get_stats()["api"]
+        self.assertEqual(stats["throttled"], 1)
+        self.assertGreater(stats["blocked_for_seconds"], 0)
+        with patch("ratelimit.MAX_WAIT", 0.1):
+            with self.assertRaises(RateLimitTimeout):
+                limiter.acquire("api")
+
+    def test_background_requests_use_their_own_budget(self):
+        limits = {"api": RateBudget(rate=100, burst=100), ratelimit.background_bucket("api"): RateBudget(rate=1, burst=1)}
+        response = requests.Response()
+        response.status_code = 200
+        adapter = ratelimit.RateLimitedAdapter()
+        request = requests.Request("GET", "https://api/").prepare()
+        with patch("ratelimit.limiter", RateLimiter(Path(self.tmp.name) / "ratelimit.sqlite", limits)), \
+                patch("requests.adapters.HTTPAdapter.send", return_value=response), patch("ratelimit.MAX_WAIT", 0.1):
+            for _ in range(3):
+                adapter.send(request)  # Interactive requests are not limited by the background budget
+            with ratelimit.in_background():
+                adapter.send(request)
+                with self.assertRaises(RateLimitTimeout):
+                    adapter.send(request)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_failures_and_closes_after_trial(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        for _ in range(2):
+            breaker.before_call("host")
+            breaker.record_failure("host")
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call("host")
+        time.sleep(0.25)
+        breaker.before_call("host")  # Trial call
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call("host")  # Only one trial at a time
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+
+class TestAlbumFallbacks(DatabaseTestCase):
+    databases = (album_fallbacks,)
+
+    def test_ttl_grows_with_attempts(self):
+        self.assertIsNone(album_fallbacks.get_keep_days("Artist", "Album"))
+        album_fallbacks.record_failure("Artist", "Album")
+        first = album_fallbacks.get_keep_days("Artist", "Album")
+        album_fallbacks.record_failure("Artist", "Album")
+        self.assertEqual(album_fallbacks.get_keep_days("Artist", "Album"), 2 * first)
+        self.assertEqual(album_fallbacks.get_summary(), dict(total=1, per_attempts={2: 1}))
+        self.assertEqual(album_fallbacks.get_due(), [])
+        with freeze_time(datetime.now() + timedelta(days=1)):
+            self.assertEqual(album_fallbacks.get_due(), [("Artist", "Album")])
+        album_fallbacks.record_success("Artist", "Album")
+        self.assertIsNone(album_fallbacks.get_keep_days("Artist", "Album"))
+
+    def test_fallback_is_cached_shortly(self):
+        self.assertIsNone(scrape.album_details_keep_days("12,https://img", "Artist", "Album"))
+        album_fallbacks.record_failure("Artist", "Album")
+        self.assertEqual(scrape.album_details_keep_days("13.48,", "Artist", "Album"), album_fallbacks.FALLBACK_BASE_TTL)
+
+
+class TestCharts(unittest.TestCase):
+    def test_sum_weekly_charts(self):
+        weeks = [
+            [["Album A", "Artist", "10", "1"], ["Album B", "Artist", "4", "2"]],
+            [["Album B", "Artist", "8", "1"], ["Album C", "Other", "1", "2"]],
+        ]
+        self.assertEqual(
+            charts.sum_charts(weeks, limit=2),
+            [("Album B", "Artist", "12", "1"), ("Album A", "Artist", "10", "2")],
+        )
+
+    def test_weeks_are_counted_in_period_of_their_midpoint(self):
+        day = 24 * 3600
+        chart_list = json.dumps([(0, 7 * day), (7 * day, 14 * day), (14 * day, 21 * day)])
+        with patch("charts.get_weekly_chart_list", return_value=chart_list):
+            self.assertEqual(charts.get_weeks_between("user", 3 * day, 10 * day), [(0, 7 * day)])
+            self.assertEqual(charts.get_weeks_between("user", 3 * day, 17 * day), [(0, 7 * day), (7 * day, 14 * day)])
+
+    def test_period_with_missing_weeks_is_fetched_in_one_call(self):
+        day = 24 * 3600
+        chart_list = json.dumps([(i * 7 * day, (i + 1) * 7 * day) for i in range(4)])
+        cached_weeks = {"0", str(7 * day)}
+
+        def get_updated(username, start, end, func_name):
+            return start in cached_weeks and 1
+
+        with patch("charts.get_weekly_chart_list", return_value=chart_list), \
+                patch("charts.get_updated", get_updated), \
+                patch("charts.get_weekly_album_chart", return_value=json.dumps([["Album", "Artist", "2", "1"]])), \
+                patch("charts.period_index.index_in_background") as index, \
+                patch("scrape.get_album_stats", return_value=[["Other", "Artist", "9", "1"]]) as one_call:
+            # All weeks are cached, or only one is missing
+            stats = charts.get_album_stats_between("user", datetime.fromtimestamp(0), datetime.fromtimestamp(21 * day))
+            self.assertEqual(stats, [["Album", "Artist", "6", "1"]])
+            one_call.assert_not_called()
+            stats = charts.get_album_stats_between("user", datetime.fromtimestamp(0), datetime.fromtimestamp(28 * day))
+            self.assertEqual(stats, [["Other", "Artist", "9", "1"]])
+            self.assertIn(f"from=0&to={28 * day}", one_call.call_args[0][1])
+            index.assert_called_once_with("user")
+
+
+class TestRecentUsers(DatabaseTestCase):
+    databases = (recent_users,)
+
+    def test_ring_is_bounded_and_most_recent_first(self):
+        with patch("recent_users.RING_SIZE", 3):
+            for i, username in enumerate(["a", "b", "c", "a", "d"]):
+                recent_users.add(username, seen=i)
+            self.assertEqual(recent_users.get_recent(), ["d", "a", "c"])
+
+    def test_snapshot(self):
+        self.assertEqual(recent_users.get_snapshot(), [])
+        recent_users.save_snapshot([("a", dict(album_name="Album"))])
+        self.assertEqual(recent_users.get_snapshot(), [["a", dict(album_name="Album")]])
+
+    def test_snapshot_is_not_refreshed_by_every_starting_worker(self):
+        from app import homepage_snapshot_job, scheduler
+        # The app runs the job when it is imported, wait for that run so it does not hold the lock.
+        scheduler.pause()
+        self.addCleanup(scheduler.resume)
+        with file_cache.key_lock("homepage_snapshot", "run"):
+            pass
+        recent_users.save_snapshot([])
+        with patch("app.refresh_homepage_snapshot") as refresh:
+            homepage_snapshot_job()  # A worker that starts
+            self.assertEqual(refresh.call_count, 0)
+            with freeze_time(datetime.now() + timedelta(seconds=recent_users.SNAPSHOT_INTERVAL)):
+                homepage_snapshot_job()
+            self.assertEqual(refresh.call_count, 1)
+
+
+class TestPeriodIndex(DatabaseTestCase):
+    databases = (period_index,)
+
+    def setUp(self):
+        super().setUp()
+        week = 7 * 24 * 3600
+        first = int(datetime(2020, 3, 1, 12).timestamp())
+        # The first week is before the user registered
+        self.weeks = [(first + i * week, first + (i + 1) * week) for i in range(-1, 3)]
+        chart_list = patch("charts.get_weekly_chart_list", return_value=json.dumps(self.weeks))
+        chart_list.start()
+        self.addCleanup(chart_list.stop)
+        registered = patch("scrape.get_username_registered", return_value=first + 3600)
+        registered.start()
+        self.addCleanup(registered.stop)
+        scan = patch("period_index.scan_cache")
+        scan.start()
+        self.addCleanup(scan.stop)
+
+    @freeze_time("2026-10-17")
+    def test_random_interval_is_non_empty_and_fully_indexed(self):
+        self.assertIsNone(scrape.get_random_interval("user"))
+        (start, end), (empty_start, empty_end) = self.weeks[1:3]
+        period_index.record_week("user", start, end, 3)
+        period_index.record_week("user", empty_start, empty_end, 0)
+        midpoint = datetime.fromtimestamp((start + end) // 2)
+        for _ in range(10):
+            # The month and year of the week are not fully indexed, the other week is empty
+            name, _date_str, start_date, end_date = scrape.get_random_interval("user")
+            self.assertEqual(name, "random week")
+            self.assertTrue(start_date <= midpoint < end_date)
+        for _ in range(10):
+            # The only week since the user registered that still needs a call to last.fm
+            name, _date_str, start_date, end_date = scrape.get_unindexed_random_week("user")
+            self.assertTrue(start_date <= datetime.fromtimestamp(sum(self.weeks[3]) // 2) < end_date)
+        # Every week since the user registered is indexed, so the month and the year can be picked as well
+        period_index.record_week("user", *self.weeks[3], 1)
+        names = {scrape.get_random_interval("user")[0] for _ in range(50)}
+        self.assertEqual(names, {"random week", "random month", "random year"})
+        with patch("charts.get_weekly_chart_list", return_value=json.dumps(self.weeks)) as chart_list:
+            scrape.get_random_interval("user")
+        self.assertEqual(chart_list.call_count, 1)
+
+
+class TestHttpCache(unittest.TestCase):
+    def test_not_modified_without_rendering(self):
+        from app import app
+        client = app.test_client()
+        with patch("app.render_overview_block", return_value="<b>block</b>") as render:
+            response = client.get("/get_stats/detail?username=user&year=2020&month=5&week=None")
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            response = client.get("/get_stats/detail?username=user&year=2020&month=5&week=None", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(render.call_count, 1)
+        self.assertIn("max-age=", response.headers["Cache-Control"])
+
+    def test_partial_block_is_not_cached(self):
+        from app import app
+
+        def fail(_item):
+            raise requests.exceptions.Timeout()
+
+        def render(*_args):
+            albums = ordered_map(fail, [1], pool="album_details")
+            return f"<b>{len(albums)} albums</b>"
+
+        with patch("app.render_overview_block", side_effect=render):
+            response = app.test_client().get("/get_stats/detail?username=user&year=2020&month=5&week=None")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response.headers)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+
+    def test_streamed_overview_is_not_buffered_by_nginx(self):
+        from app import app
+        with patch("app.username_exists", return_value=True), patch("app.add_recent_user"), \
+                patch("app.get_user_overview", return_value=[]), patch("app.render_overview_blocks", return_value=iter([])):
+            response = app.test_client().get("/get_stats?username=user&range=overview")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers["X-Accel-Buffering"], "no")
+
+    def test_tiles_not_streamed_in_time_are_loaded_by_htmx(self):
+        from app import app
+        overview = [dict(year=2020), dict(year=2021)]
+        with patch("app.username_exists", return_value=True), patch("app.add_recent_user"), \
+                patch("app.get_user_overview", return_value=overview), \
+                patch("app.render_overview_blocks", return_value=iter([(1, "<b>2020</b>")])):
+            html = app.test_client().get("/get_stats?username=user&range=overview").get_data(as_text=True)
+        self.assertIn('<template id="tile-html-1"><b>2020</b></template>', html)
+        self.assertNotIn("tile-html-2", html)
+        # The placeholder of the second tile keeps its hx-get
+        self.assertIn("/get_stats/detail?username=user&year=2021", html)
+
+    def test_streamed_stats_are_not_buffered_by_nginx(self):
+        from app import app
+        raw_stats = ([], "Album", "Artist", None, None)
+        with patch("app.username_exists", return_value=True), patch("app.add_recent_user"), \
+                patch("app.get_album_stats_version", return_value=(time.time(), 30)), \
+                patch("app.get_user_raw_stats", return_value=raw_stats), \
+                patch("app.stream_corrected_stats", return_value=iter([])):
+            response = app.test_client().get("/get_stats?username=user&range=7")
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers["X-Accel-Buffering"], "no")
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+
+    def test_cover_x_accel_redirect(self):
+        from app import app
+        cover_path = file_cache.SUBDIR / "v2" / "cache_binary_url_and_return_path" / "ab" / "cd" / "abcd.png"
+        with patch("app.COVER_X_ACCEL", True), patch("app.get_cover_path", return_value=(cover_path, None)):
+            response = app.test_client().get("/static/cover/https:--lastfm.freetls.fastly.net-abcd.png")
+        self.assertEqual(response.headers["X-Accel-Redirect"], "/_cache/v2/cache_binary_url_and_return_path/ab/cd/abcd.png")
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+    def test_cover_etag_is_valid_for_any_file_name(self):
+        from app import app
+        with patch("app.COVER_X_ACCEL", True), patch("app.get_cover_path", return_value=(file_cache.SUBDIR / "x.png", None)):
+            response = app.test_client().get("/static/cover/https:--x-a%22b.png")
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response.headers["ETag"], r'^"[0-9a-f]+"$')
+
+    def test_cover_variant_is_resized(self):
+        import covers
+        if covers.Image is None:
+            self.skipTest("Pillow is not installed")
+        original = io.BytesIO()
+        covers.Image.new("RGB", (600, 600), "red").save(original, format="PNG")
+        variant = covers.make_variant(original.getvalue(), 150, "webp")
+        with covers.Image.open(io.BytesIO(variant)) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (150, 150)))
+
+
+class TestHttpClient(unittest.TestCase):
+    def test_connections_are_reused_and_timed(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        s = requests.Session()
+        s.mount("http://", http_client.TimedAdapter())
+        http_client.HTTP_STATS.pop("127.0.0.1", None)
+        for _ in range(3):
+            self.assertEqual(s.get(f"http://127.0.0.1:{server.server_port}/").text, "ok")
+        stats = http_client.get_http_stats()["127.0.0.1"]
+        self.assertEqual((stats["requests"], stats["new_connections"]), (3, 1))
+
+    def test_http_is_upgraded_to_https(self):
+        with patch("requests.Session.request") as request:
+            http_client.session.get("http://ws.audioscrobbler.com/2.0/")
+        self.assertEqual(request.call_args.args[1], "https://ws.audioscrobbler.com/2.0/")
+
+
+class TestScrobbleStore(DatabaseTestCase):
+    databases = (scrobble_store,)
+
+    @freeze_time("2026-10-17")
+    def test_incremental_sync_and_local_stats(self):
+        history = [(300, "Artist", "Album B", "3"), (200, "Artist", "Album A", "2"), (100, "Artist", "Album A", "1")]
+        with patch("scrobble_store._get_recent_tracks_api", return_value=(history, 1)) as api:
+            scrobble_store.sync("user")
+            api.assert_called_once_with("user", 1, from_ts=None, to_ts=None)
+        with patch("scrobble_store._get_recent_tracks_api", return_value=([(400, "Artist", "Album B", "4")], 1)) as api:
+            scrobble_store.sync("user")
+            api.assert_called_once_with("user", 1, from_ts=301, to_ts=int(time.time()))  # Only the new scrobbles
+        self.assertEqual(
+            scrobble_store.get_album_stats("user"),
+            [["Album B", "Artist", "2", "1"], ["Album A", "Artist", "2", "2"]],
+        )
+        self.assertEqual(
+            scrobble_store.get_album_stats("user", datetime.fromtimestamp(150), datetime.fromtimestamp(350)),
+            [["Album B", "Artist", "1", "1"], ["Album A", "Artist", "1", "2"]],
+        )
+
+    def test_interrupted_sync_is_resumed(self):
+        scrobble_store.insert("user", [(100, "Artist", "Album A", "1")])
+        scrobble_store.connection().execute("INSERT INTO sync_state (user, complete, synced) VALUES ('user', 1, 0)")
+        pages = {1: [(400, "Artist", "Album B", "4"), (300, "Artist", "Album B", "3")], 2: [(200, "Artist", "Album A", "2")]}
+
+        def page_2_fails(username, page, from_ts, to_ts):
+            if page == 2:
+                raise requests.exceptions.ConnectionError()
+            return pages[page], 2
+
+        with patch("scrobble_store._get_recent_tracks_api", page_2_fails):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                scrobble_store.sync("user")
+        with patch("scrobble_store._get_recent_tracks_api", lambda username, page, from_ts, to_ts: (pages[page], 2)):
+            scrobble_store.sync("user")
+        self.assertEqual(scrobble_store.get_album_stats("user")[1], ["Album A", "Artist", "2", "2"])
+
+
+class TestFanout(unittest.TestCase):
+    def test_results_in_original_order(self):
+        def slow_identity(i):
+            time.sleep(0.05 * (5 - i))
+            return i
+
+        self.assertEqual(ordered_map(slow_identity, range(5), pool="album_details"), [0, 1, 2, 3, 4])
+
+    def test_partial_results_after_deadline(self):
+        def maybe_slow(i):
+            if i == 1:
+                time.sleep(1)
+            if i == 2:
+                raise ValueError("upstream error")
+            return i
+
+        results = ordered_map(maybe_slow, range(4), pool="album_details", deadline=0.3)
+        self.assertEqual(results, [0, 3])
+        self.assertFalse(results.complete)
+        self.assertTrue(ordered_map(maybe_slow, [0, 3], pool="album_details").complete)
+
+    def test_completed_map_yields_in_completion_order(self):
+        def slow_identity(i):
+            time.sleep(0.05 * (3 - i))
+            return i * 10
+
+        self.assertEqual(list(completed_map(slow_identity, range(3), pool="overview")), [(2, 20), (1, 10), (0, 0)])
+
+    def test_stream_corrected_stats_ends_with_sorted_stats(self):
+        def corrected(stat):
+            return dict(album_name=stat[0], album_scrobble_count=float(stat[2]), cover_url="")
+
+        with patch("util._get_corrected_stats_for_album", corrected):
+            updates = list(util.stream_corrected_stats([("A", "X", "1", "1"), ("B", "X", "5", "2")]))
+        self.assertEqual([event for event, _value in updates], ["album", "album", "done"])
+        self.assertEqual([album["album_name"] for album in updates[-1][1]["stats"]], ["B", "A"])
+
+    def test_overview_keeps_order_of_periods(self):
+        def get_stats(username, year, month):
+            time.sleep(0.01 * (12 - month))
+            return [["Album", "Artist", str(month), "1"]] if month % 2 else None
+
+        with patch("scrape.get_username_start_year", return_value=2010), \
+                patch("scrape.get_album_stats_year_month", get_stats):
+            overview = scrape.get_overview_per_month("user", 2010)
+        self.assertEqual(list(overview), list(range(1, 13)))
+        self.assertEqual(overview[2], [])
+        self.assertEqual(overview[3], [["Album", "Artist", "3", "1"]])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,13 +1,11 @@
-import json
 import urllib.parse
 
 from datetime import datetime
-from os import truncate
-from typing import List
-from functools import wraps, lru_cache
+from functools import wraps
 
-from jobssynchronizer import JobsSynchronizer
-from file_cache import file_cache_decorator
+import recent_users
+from fanout import Results, completed_map, ordered_map
+from file_cache import Uncacheable, fragment_cache_decorator
 from scrape import (
     _get_corrected_stats_for_album,
     get_album_stats_inc_random,
@@ -18,8 +16,6 @@ from scrape import (
     get_username_start_year,
 )
 
-RECENT_USERS_FILE = "recent.txt"
-
 
 def render_msg_template(title, text):
     from app import env
@@ -59,26 +55,8 @@ def logger():
     return inner
 
 
-@file_cache_decorator(keep_days=1)
-def get_recent_users():
-    # Use a file cache because we use multiple workers
-    try:
-        with open(RECENT_USERS_FILE) as f:
-            return f.read()
-    except FileNotFoundError:
-        return "last.hq"
-
-
 def add_recent_user(username):
-    with open(RECENT_USERS_FILE, "a") as f:
-        f.write(username + "\n")
-
-
-def trunc_recent_user_file(latest_recent_users: List):
-    # most recent user is at the start of the list, so we reverse the list to put the most recent user at the end of the file
-    truncate(RECENT_USERS_FILE, 0)
-    for u in reversed(latest_recent_users):
-        add_recent_user(u)
+    recent_users.add(username)
 
 
 def get_user_top_albums(username):
@@ -93,48 +71,35 @@ def get_user_top_albums(username):
     return corrected_sorted[0] if corrected_sorted else None
 
 
-@file_cache_decorator(keep_days=1)
-def get_recent_users_with_stats():
-    # recent users are appended to file so the most recent one is at the end of the file. We reverse so that it is now at the start of the list.
-    # get last 10 unique recent users with stats (keep order)
-    recent_users = []
+def refresh_homepage_snapshot():
+    # Recent users with their all time top album, most recent first. Run by a background job.
+    recent_users.import_legacy_file()
     recent_stats = []
-    for u in reversed(get_recent_users().splitlines()):
-        if u not in recent_users:
-            if stats := get_user_top_albums(u):
-                recent_users.append(u)
-                recent_stats.append((u, stats))
-        if len(recent_users) >= 10:
-            trunc_recent_user_file(recent_users[:10])
+    for username in recent_users.get_recent():
+        try:
+            if stats := get_user_top_albums(username):
+                recent_stats.append((username, stats))
+        except Exception as e:
+            print(f"Skipping recent user {username} for homepage: {e!r}")
+        if len(recent_stats) >= recent_users.SNAPSHOT_SIZE:
             break
-    # dump to json to be able to cache it as string
-    return json.dumps(recent_stats)
-
-
-def _get_corrected_stats_for_album_thread(job_synchronizer, stat):
-    result = _get_corrected_stats_for_album(stat)
-    job_synchronizer.notify_task_completion(result)
+    recent_users.save_snapshot(recent_stats)
 
 
 def correct_album_stats_thread(stats):
+    # Resolve the album details concurrently. Albums that are not resolved before the deadline are left out,
+    # then the results are not complete.
     if not stats:
-        return ()
-    job_synchronizer = JobsSynchronizer(len(stats))
-    from app import scheduler
-    for stat in stats:
-        scheduler.add_job(
-            func=_get_corrected_stats_for_album_thread,
-            trigger="date",
-            args=[job_synchronizer, stat],
-            id='-'.join(stat),
-            max_instances=10,
-            misfire_grace_time=60,
-        )
-    job_synchronizer.wait_for_tasks_to_be_completed()
-    return job_synchronizer.get_status_list()
-
-
-@lru_cache()
+        return Results()
+    return ordered_map(_get_corrected_stats_for_album, stats, pool="album_details")
+
+
+def overview_block_keep_days(fragment):
+    # An empty block can be a period that just ended and has no charts yet, so check again tomorrow.
+    return None if fragment else 1
+
+
+@fragment_cache_decorator(keep_days=7, keep_days_for=overview_block_keep_days)
 def render_overview_block(username, year, month, week):
     per_month = False
     if week:
@@ -151,6 +116,14 @@ def render_overview_block(username, year, month, week):
     if not stats:
         return ''  # No listening data in this period
     corrected = correct_album_stats_thread(stats)
+    html = render_top_album_block(username, year, per, per_month, corrected)
+    if not corrected.complete:
+        # Albums are missing after the deadline, so the top album may be wrong. Try again on the next view.
+        raise Uncacheable(html)
+    return html
+
+
+def render_top_album_block(username, year, per, per_month, corrected):
     if not corrected:
         return ''  # No listening data in this period
     top_album = sorted(corrected, key=lambda x: -x["album_scrobble_count"])[0]
@@ -177,7 +150,18 @@ def render_overview_block(username, year, month, week):
     )
 
 
-@lru_cache
+def render_overview_blocks(username, year, overview):
+    # Render all tiles of an overview concurrently. Yields (index, html) as soon as a tile is done, so the
+    # overview page can stream them in one request instead of one request (and worker) per tile.
+    def render_tile(indexed_stat):
+        _index, stat = indexed_stat
+        return render_overview_block(username, year or stat["year"], stat.get("month"), stat.get("week"))
+
+    for (index, _stat), html in completed_map(render_tile, enumerate(overview, start=1), pool="overview"):
+        yield index, html
+
+
+@fragment_cache_decorator(keep_days=1)
 def get_user_overview(username: str, year: int = None, overview_per_week: bool = False):
     retval = []
     if not year:
@@ -196,7 +180,8 @@ def get_user_overview(username: str, year: int = None, overview_per_week: bool =
     return retval
 
 
-def get_user_stats(username: str, drange: str):
+def get_user_raw_stats(username: str, drange: str):
+    # The stats from last.fm, before correcting them with the album track counts.
     username = username.strip()
     assert username and username_exists(username)
     stats, blast_name, period = get_album_stats_inc_random(username, drange)
@@ -206,12 +191,22 @@ def get_user_stats(username: str, drange: str):
     original_album, original_artist, _orginal_playcount, _original_position = (
         sorted_stats[0] if sorted_stats else (None, None, None, None)
     )
-    corrected = correct_album_stats_thread(stats)
+    return stats, original_album, original_artist, blast_name, period
+
+
+def sort_corrected_stats(corrected):
     corrected_sorted = sorted(list(corrected), key=lambda x: -x["album_scrobble_count"])
     top_album_cover_filename = "unknown.png"
     if corrected_sorted and corrected_sorted[0] and corrected_sorted[0]["cover_url"]:
         # Replace part of the url to be able to pass it as a file name.
         top_album_cover_filename = corrected_sorted[0]["cover_url"].replace("/", "-")
+    return corrected_sorted, top_album_cover_filename
+
+
+def get_user_stats(username: str, drange: str):
+    stats, original_album, original_artist, blast_name, period = get_user_raw_stats(username, drange)
+    corrected = correct_album_stats_thread(stats)
+    corrected_sorted, top_album_cover_filename = sort_corrected_stats(corrected)
     return (
         corrected_sorted,
         original_album,
@@ -222,6 +217,16 @@ def get_user_stats(username: str, drange: str):
     )
 
 
+def stream_corrected_stats(stats):
+    # Yields ("album", corrected album) as soon as each album is resolved, followed by ("done", final stats).
+    corrected = []
+    for _stat, album in completed_map(_get_corrected_stats_for_album, stats, pool="album_details"):
+        corrected.append(album)
+        yield "album", album
+    corrected_sorted, top_album_cover_filename = sort_corrected_stats(corrected)
+    yield "done", dict(stats=corrected_sorted, top_album_cover_path="/static/cover/" + top_album_cover_filename)
+
+
 def save_correction(artist, album, original_count, count):
     artist = urllib.parse.unquote_plus(artist)
     album = urllib.parse.unquote_plus(album)
@@ -237,8 +242,7 @@ def get_period_stats(username, year, month=None, week=None):
         stats = get_album_stats_year_month(username, year, month) or []
     else:
         stats = get_album_stats_year_month(username, year) or []
+    # Keeps the complete flag of correct_album_stats_thread, also when nothing is left.
     corrected = correct_album_stats_thread(stats)
-    if not corrected:
-        return []
     corrected.sort(key=lambda x: -x["album_scrobble_count"])
     return corrected
@@ -1,13 +1,9 @@
 import json
-import requests
-from typing import Optional
+from typing import List, Optional, Tuple
 
 
 from config import LASTFM_API_KEY as API_KEY
-
-session = requests.Session()
-a = requests.adapters.HTTPAdapter(max_retries=3)
-session.mount("https://", a)
+from http_client import conditional_get, session
 
 API_PERIOD = {
     None: 'overall',
@@ -28,7 +24,7 @@ def _get_album_stats_api(
     if drange and drange.startswith("http"):
         url = drange + f'&limit={MAX_ITEMS}&api_key={API_KEY}'
         print("Getting " + url.replace(API_KEY, 'SECRET'))
-        resp = session.get(url, timeout=TIMEOUT)
+        resp = conditional_get(url, timeout=TIMEOUT)
         resp.raise_for_status()
         j = resp.json()
         # Dump as json so we can cache it to disk
@@ -46,7 +42,7 @@ def _get_album_stats_api(
     elif p := API_PERIOD[drange]:
         url = f"https://ws.audioscrobbler.com/2.0/?method=user.gettopalbums&user={username}&api_key={API_KEY}&period={p}&format=json&limit={MAX_ITEMS}"
         print("Getting " + url.replace(API_KEY, 'SECRET'))
-        resp = session.get(url, timeout=TIMEOUT)
+        resp = conditional_get(url, timeout=TIMEOUT)
         resp.raise_for_status()
         j = resp.json()
         # Dump as json so we can cache it to disk
@@ -64,7 +60,7 @@ def _get_album_stats_api(
 
 
 def _get_user_info(username):
-    url = f'http://ws.audioscrobbler.com/2.0/?method=user.getinfo&user={username}&api_key={API_KEY}&format=json'
+    url = f'https://ws.audioscrobbler.com/2.0/?method=user.getinfo&user={username}&api_key={API_KEY}&format=json'
     print("Getting " + url.replace(API_KEY, 'SECRET'))
     from scrape import TIMEOUT
     resp = session.get(url, timeout=TIMEOUT)
@@ -72,3 +68,81 @@ def _get_user_info(username):
         return ''
     # Dump json as text so we can cache it to disk
     return resp.text
+
+
+def _get_album_info_api(artist_name: str, album_name: str) -> Tuple[Optional[int], str, int]:
+    # Returns track count (None if unknown), cover url and the number of bytes downloaded.
+    from scrape import TIMEOUT
+    params = dict(method='album.getinfo', artist=artist_name, album=album_name, api_key=API_KEY, format='json')
+    print(f"Getting album.getinfo {artist_name} - {album_name}")
+    resp = session.get('https://ws.audioscrobbler.com/2.0/', params=params, timeout=TIMEOUT)
+    resp.raise_for_status()
+    album = resp.json().get('album')
+    if not album:
+        return None, '', len(resp.content)
+    tracks = album.get('tracks', {}).get('track', [])
+    if isinstance(tracks, dict):
+        tracks = [tracks]  # A single track is not wrapped in a list
+    # Images are ordered from small to large
+    images = [image['#text'] for image in album.get('image', []) if image.get('#text')]
+    return len(tracks) or None, images[-1] if images else '', len(resp.content)
+
+
+def _get_weekly_chart_list_api(username: str) -> str:  # returns json
+    from scrape import TIMEOUT
+    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklychartlist&user={username}&api_key={API_KEY}&format=json"
+    print("Getting " + url.replace(API_KEY, 'SECRET'))
+    resp = conditional_get(url, timeout=TIMEOUT)
+    resp.raise_for_status()
+    j = resp.json()
+    # Dump as json so we can cache it to disk
+    return json.dumps(
+        [(int(chart['from']), int(chart['to'])) for chart in j['weeklychartlist']['chart']]
+    )
+
+
+def _get_weekly_album_chart_api(username: str, start: int, end: int) -> str:  # returns json
+    # The complete chart, not only the top albums, so charts can be summed into longer periods.
+    from scrape import TIMEOUT
+    url = f"https://ws.audioscrobbler.com/2.0/?method=user.getweeklyalbumchart&user={username}&api_key={API_KEY}&format=json&from={start}&to={end}&limit=1000"
+    print("Getting " + url.replace(API_KEY, 'SECRET'))
+    resp = session.get(url, timeout=TIMEOUT)
+    resp.raise_for_status()
+    j = resp.json()
+    # Dump as json so we can cache it to disk
+    return json.dumps(
+        [
+            (
+                top['name'],
+                top['artist']['#text'],
+                top['playcount'],
+                top['@attr']['rank'],
+            )
+            for top in j['weeklyalbumchart']['album']
+        ]
+    )
+
+
+def _get_recent_tracks_api(
+    username: str, page: int = 1, from_ts: Optional[int] = None, to_ts: Optional[int] = None
+) -> Tuple[List[Tuple[int, str, str, str]], int]:
+    # Returns scrobbles as (timestamp, artist, album, track), newest first, and the number of pages.
+    from scrape import TIMEOUT
+    params = dict(method='user.getrecenttracks', user=username, api_key=API_KEY, format='json', limit=200, page=page)
+    if from_ts:
+        params['from'] = from_ts
+    if to_ts:
+        params['to'] = to_ts
+    print(f"Getting user.getrecenttracks {username} page {page} {from_ts=} {to_ts=}")
+    resp = session.get('https://ws.audioscrobbler.com/2.0/', params=params, timeout=TIMEOUT)
+    resp.raise_for_status()
+    j = resp.json()['recenttracks']
+    tracks = j.get('track', [])
+    if isinstance(tracks, dict):
+        tracks = [tracks]  # A single track is not wrapped in a list
+    scrobbles = [
+        (int(track['date']['uts']), track['artist']['#text'], track['album']['#text'], track['name'])
+        for track in tracks
+        if 'date' in track  # Skip the track that is playing now
+    ]
+    return scrobbles, int(j['@attr']['totalPages'])